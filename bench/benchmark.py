@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+""" Benchmark the pcs-* scripts against a local stand-in for the Prisma Cloud Support API. """
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_api import MockServer, tenant_name
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+##########################################################################################
+# Helpers.
+##########################################################################################
+
+def output(output_data=''):
+    print(output_data)
+
+def create_workspace(mock_server, work_dir, customers):
+    """ Copy the scripts to work_dir, with a configuration for the mock stacks and a (JSON) file of customer names. """
+    for file_name in os.listdir(REPO_DIR):
+        if file_name.endswith('.py') and file_name != 'config.py':
+            shutil.copy(os.path.join(REPO_DIR, file_name), work_dir)
+    stacks = {}
+    for stack in mock_server.stacks:
+        stacks[stack] = {'url': mock_server.url(stack), 'access_key': 'access_key', 'secret_key': 'secret_key'}
+    with open(os.path.join(work_dir, 'config.py'), 'w', encoding='utf8') as config_file:
+        config_file.write('CONFIG = {}\n')
+        config_file.write("CONFIG['CA_BUNDLE'] = None\n")
+        config_file.write("CONFIG['CACHE_FILE'] = %r\n" % os.path.join(work_dir, 'cache.sqlite3'))
+        config_file.write("CONFIG['STACKS'] = %r\n" % stacks)
+    customers_file_name = os.path.join(work_dir, 'customers.json')
+    with open(customers_file_name, 'w', encoding='utf8') as customers_file:
+        json.dump(customers, customers_file)
+    return customers_file_name
+
+def sample_customers(mock_server, count, tenants):
+    """ Customer names, spread (reproducibly) across the stacks and their tenant lists. """
+    rng = random.Random(0)
+    return [tenant_name(rng.choice(mock_server.stacks), rng.randrange(tenants)) for _ in range(count)]
+
+def run(mock_server, work_dir, command):
+    """ Run command, returning its elapsed time, peak memory (in MB), and API request (and error) counts of the last run. """
+    mock_server.reset()
+    with tempfile.TemporaryFile() as error_file:
+        start_time = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=error_file)
+        # Wait with wait4() rather than process.wait() to get the resource usage of this process alone.
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start_time
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            error_file.seek(0)
+            output('Error: %s exited with status %d\n%s' % (' '.join(command), process.returncode, error_file.read().decode()))
+            sys.exit(1)
+    # ru_maxrss is in kilobytes on Linux (and bytes on macOS).
+    peak_memory = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return elapsed, peak_memory, mock_server.snapshot()
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+##########################################################################################
+## Main.
+##########################################################################################
+
+if __name__ == '__main__':
+    bench_parser = argparse.ArgumentParser(description='Benchmark the pcs-* scripts against a local mock of the Prisma Cloud Support API', prog=os.path.basename(__file__))
+
+    bench_parser.add_argument('--customers', default=10, type=int, help='(Optional) Number of customers to search for (Default: 10)')
+    bench_parser.add_argument('--stacks', default=4, type=int, help='(Optional) Number of stacks (Default: 4)')
+    bench_parser.add_argument('--tenants', default=5000, type=int, help='(Optional) Tenants per stack (Default: 5000)')
+    bench_parser.add_argument('--users', default=50, type=int, help='(Optional) Users per tenant (Default: 50)')
+    bench_parser.add_argument('--latency', default=0.05, type=float, help='(Optional) Mean API latency in seconds (Default: 0.05)')
+    bench_parser.add_argument('--rate_429', default=0.0, type=float, help='(Optional) Fraction of API requests to throttle (Default: 0)')
+    bench_parser.add_argument('--rate_5xx', default=0.0, type=float, help='(Optional) Fraction of API requests to fail (Default: 0)')
+    bench_parser.add_argument('--runs', default=3, type=int, help='(Optional) Runs of each scenario (Default: 3)')
+    bench_parser.add_argument('--args', default='', type=str, help="(Optional) Additional pcs-where-is.py arguments, for example: --args='-w 4 -l -u'")
+    bench_parser.add_argument('--json', default=None, type=str, help='(Optional) Also write results to this (JSON) file')
+    args = bench_parser.parse_args()
+
+    server = MockServer(0, args.stacks, args.tenants, args.users, args.latency, args.rate_429, args.rate_5xx).start()
+    workspace = tempfile.mkdtemp(prefix='pcs-bench-')
+    try:
+        customers_file = create_workspace(server, workspace, sample_customers(server, args.customers, args.tenants))
+        extra_args = args.args.split()
+        scenarios = [
+            ('pcs-where-is.py', ['pcs-where-is.py', customers_file] + extra_args),
+            # For comparison with the wall clock time of the (parallel, with --args='-w N') scenario above.
+            ('pcs-where-is.py (sequential)', ['pcs-where-is.py', customers_file] + extra_args + ['-w', '1']),
+            ('pcs-where-is.py --cache (cold)', ['pcs-where-is.py', customers_file, '--cache'] + extra_args),
+            ('pcs-where-is.py --cache (warm)', ['pcs-where-is.py', customers_file, '--cache'] + extra_args),
+            ('pcs-app-stack-version.py', ['pcs-app-stack-version.py']),
+        ]
+        output('%d customers x %d stacks (%d tenants, %d users per tenant, %.3fs latency)\n' % (args.customers, args.stacks, args.tenants, args.users, args.latency))
+        output('%-*s %10s %10s %10s %10s %10s  %s' % (32, 'Scenario', 'Seconds', 'Peak MB', 'Requests', '429s', '5xxs', 'Requests by endpoint'))
+        results = []
+        for scenario, scenario_command in scenarios:
+            timings = []
+            memory = []
+            for _ in range(args.runs):
+                if scenario.endswith('(cold)') and os.path.exists(os.path.join(workspace, 'cache.sqlite3')):
+                    os.remove(os.path.join(workspace, 'cache.sqlite3'))
+                run_elapsed, run_memory, stats = run(server, workspace, scenario_command)
+                timings.append(run_elapsed)
+                memory.append(run_memory)
+            counts = stats['requests']
+            result = {'scenario': scenario, 'seconds': median(timings), 'peak_mb': max(memory), 'requests': sum(counts.values()), 'requests_by_endpoint': counts, 'errors': stats['errors']}
+            results.append(result)
+            output('%-*s %10.2f %10.1f %10d %10d %10d  %s' % (32, scenario, result['seconds'], result['peak_mb'], result['requests'], stats['errors']['throttled'], stats['errors']['failed'], ', '.join('%s: %d' % item for item in sorted(counts.items()))))
+        if args.json:
+            with open(args.json, 'w', encoding='utf8') as json_file:
+                json.dump({'parameters': vars(args), 'results': results}, json_file, indent=4)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+        server.shutdown()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+""" A local stand-in for the Prisma Cloud Support API, for benchmarks. """
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+##########################################################################################
+# Data.
+##########################################################################################
+
+def tenant_name(stack, index):
+    return 'Tenant %s %06d' % (stack, index)
+
+def generate_tenants(stack_number, stack, count):
+    tenants = []
+    for index in range(count):
+        prisma_id = 800000000000000000 + stack_number * 1000000000 + index * 2
+        marketplace_data = None
+        if index % 4:
+            marketplace_data = {'tenantId': str(prisma_id + 1), 'serialNumber': 'PA%08d%s' % (index, stack.upper())}
+        tenants.append({
+            'customerName': tenant_name(stack, index),
+            'customerId': index,
+            'prismaId': str(prisma_id),
+            'eval': index % 7 == 0,
+            'active': True,
+            'workloads': 1000 + index,
+            'licenseDetails': {'endTs': 1767225599000, 'marketplaceData': marketplace_data}
+        })
+    return tenants
+
+def generate_users(count):
+    now = int(time.time() * 1000)
+    users = []
+    for index in range(count):
+        users.append({
+            'displayName': 'User %05d' % index,
+            'email': 'user%05d@example.com' % index,
+            'timeZone': ['America/New_York', 'Europe/London', 'Asia/Tokyo', 'UTC'][index % 4],
+            'lastLoginTs': -1 if index % 9 == 0 else now - index * 3600 * 1000
+        })
+    return users
+
+##########################################################################################
+# Server.
+##########################################################################################
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Requests are routed by the path following the stack name: http://host:port/<stack>/<endpoint> """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        return json.loads(body) if body else {}
+
+    def respond(self, status, body=None, headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, action):
+        server = self.server
+        path = urlsplit(self.path).path
+        body = self.read_body() if action == 'POST' else {}
+        if path.startswith('/_mock/'):
+            if path == '/_mock/reset':
+                server.reset()
+            if path == '/_mock/churn':
+                server.churn(int(parse_qs(urlsplit(self.path).query).get('count', ['10'])[0]))
+            self.respond(200, server.snapshot())
+            return
+        _, stack, endpoint = path.split('/', 2)
+        endpoint = '/' + endpoint
+        server.count(endpoint)
+        if server.latency:
+            time.sleep(random.uniform(0, 2 * server.latency))
+        if endpoint == '/login':
+            token = uuid.uuid4().hex
+            with server.lock:
+                server.tokens.add(token)
+            self.respond(200, {'token': token})
+            return
+        if self.headers.get('x-redlock-auth') not in server.tokens:
+            self.respond(401, {})
+            return
+        draw = random.random()
+        if draw < server.rate_429:
+            server.count_error('throttled')
+            self.respond(429, {}, {'Retry-After': '1'})
+            return
+        if draw < server.rate_429 + server.rate_5xx:
+            server.count_error('failed')
+            self.respond(503, {})
+            return
+        if stack not in server.stacks:
+            self.respond(404, {})
+        elif endpoint == '/version':
+            self.respond(200, server.version)
+        elif endpoint == '/_support/customer':
+            if server.etags and self.headers.get('If-None-Match') == server.etags[stack]:
+                self.respond(304, b'', {'ETag': server.etags[stack]})
+            else:
+                self.respond(200, server.customer_lists[stack], {'ETag': server.etags[stack]} if server.etags else None)
+        elif endpoint == '/_support/license/api/v1/usage/time_series':
+            self.respond(200, {'dataPoints': [{'counts': {'aws': {'iaas': 100, 'host': 20}, 'azure': {'iaas': 10}}}]})
+        elif endpoint == '/_support/license/api/v2/usage':
+            # Paged: each page has its own items and stats.
+            page = int(body.get('pageToken') or 0)
+            next_page = str(page + 1) if page + 1 < server.license_pages else None
+            self.respond(200, {'items': [{'accountId': 'account-%d' % page}], 'stats': {'total': 130, 'iaas': 110, 'host': 20}, 'nextPageToken': next_page})
+        elif endpoint == '/_support/license':
+            self.respond(200, {'activePlanType': 'RS_STANDARD'})
+        elif endpoint == '/v2/_support/user':
+            self.respond(200, server.users)
+        else:
+            self.respond(404, {})
+
+class MockServer(ThreadingHTTPServer):
+    """ Serve a number of stacks, each with the given number of tenants (and users per tenant). """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, stacks=1, tenants=1000, users=50, latency=0.0, rate_429=0.0, rate_5xx=0.0, version='mock', license_pages=3, etags=True):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.stacks = ['stack%d' % index for index in range(stacks)]
+        self.tenant_lists = {stack: generate_tenants(number, stack, tenants) for number, stack in enumerate(self.stacks)}
+        self.customer_lists = {}
+        # Tenant lists have an ETag (for conditional requests) unless etags is False.
+        self.etags = {} if etags else None
+        for stack in self.stacks:
+            self.serialize(stack)
+        self.users = generate_users(users)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.version = version
+        self.license_pages = license_pages
+        self.tokens = set()
+        self.counts = {}
+        self.errors = {'throttled': 0, 'failed': 0}
+        self.lock = threading.Lock()
+
+    def serialize(self, stack):
+        # The tenant lists are serialized up front (and when changed), to keep the server out of the measurements.
+        self.customer_lists[stack] = json.dumps(self.tenant_lists[stack]).encode()
+        if self.etags is not None:
+            self.etags[stack] = '"%s"' % hashlib.sha1(self.customer_lists[stack]).hexdigest()
+
+    def churn(self, count):
+        """ Change the credits of count tenants of each stack. """
+        with self.lock:
+            for stack in self.stacks:
+                for tenant in random.sample(self.tenant_lists[stack], min(count, len(self.tenant_lists[stack]))):
+                    tenant['workloads'] += 1
+                self.serialize(stack)
+
+    def url(self, stack):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], stack)
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def count_error(self, error):
+        with self.lock:
+            self.errors[error] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.errors = {'throttled': 0, 'failed': 0}
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': dict(self.counts), 'errors': dict(self.errors)}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+##########################################################################################
+## Main.
+##########################################################################################
+
+if __name__ == '__main__':
+    mock_parser = argparse.ArgumentParser(description='Local stand-in for the Prisma Cloud Support API')
+    mock_parser.add_argument('--port', default=8080, type=int, help='(Optional) Port (Default: 8080)')
+    mock_parser.add_argument('--stacks', default=1, type=int, help='(Optional) Number of stacks (Default: 1)')
+    mock_parser.add_argument('--tenants', default=1000, type=int, help='(Optional) Tenants per stack (Default: 1000)')
+    mock_parser.add_argument('--users', default=50, type=int, help='(Optional) Users per tenant (Default: 50)')
+    mock_parser.add_argument('--latency', default=0.0, type=float, help='(Optional) Mean response latency in seconds (Default: 0)')
+    mock_parser.add_argument('--rate_429', default=0.0, type=float, help='(Optional) Fraction of requests to throttle (Default: 0)')
+    mock_parser.add_argument('--rate_5xx', default=0.0, type=float, help='(Optional) Fraction of requests to fail (Default: 0)')
+    mock_parser.add_argument('--license_pages', default=3, type=int, help='(Optional) Pages of license usage per tenant (Default: 3)')
+    mock_parser.add_argument('--no_etags', action='store_true', help='(Optional) Do not support conditional requests for tenant lists')
+    args = mock_parser.parse_args()
+    mock_server = MockServer(args.port, args.stacks, args.tenants, args.users, args.latency, args.rate_429, args.rate_5xx, license_pages=args.license_pages, etags=not args.no_etags)
+    for mock_stack in mock_server.stacks:
+        print('%s: %s' % (mock_stack, mock_server.url(mock_stack)))
+    try:
+        mock_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
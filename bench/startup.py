@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+""" Benchmark the startup time of pcs-where-is.py for quick (cached) lookups. """
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import create_workspace, median, output, sample_customers
+from mock_api import MockServer
+
+# Dependencies that are slow to import, and only needed on some code paths.
+HEAVY_MODULES = ['requests', 'arrow', 'dateutil', 'concurrent.futures']
+
+##########################################################################################
+# Helpers.
+##########################################################################################
+
+def time_command(command, work_dir, runs):
+    """ Return the median elapsed time of command, and the (cumulative) import time of each heavy module it imported. """
+    timings = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start_time)
+    # -X importtime reports: import time: self [us] | cumulative | imported package
+    import_log = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True).stderr.decode()
+    imports = {}
+    for line in import_log.splitlines():
+        match = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s+(\S+)$', line)
+        if match and match.group(2) in HEAVY_MODULES:
+            imports[match.group(2)] = int(match.group(1)) / 1000000
+    return median(timings), imports
+
+##########################################################################################
+## Main.
+##########################################################################################
+
+if __name__ == '__main__':
+    startup_parser = argparse.ArgumentParser(description='Benchmark the startup time of pcs-where-is.py for quick (cached) lookups', prog=os.path.basename(__file__))
+    startup_parser.add_argument('--stacks', default=4, type=int, help='(Optional) Number of stacks (Default: 4)')
+    startup_parser.add_argument('--tenants', default=5000, type=int, help='(Optional) Tenants per stack (Default: 5000)')
+    startup_parser.add_argument('--runs', default=10, type=int, help='(Optional) Runs of each command (Default: 10)')
+    args = startup_parser.parse_args()
+
+    server = MockServer(0, args.stacks, args.tenants, users=10).start()
+    workspace = tempfile.mkdtemp(prefix='pcs-startup-')
+    try:
+        create_workspace(server, workspace, [])
+        customer = sample_customers(server, 1, args.tenants)[0]
+        # Warm the cache.
+        subprocess.run([sys.executable, 'pcs-where-is.py', customer, '--cache'], cwd=workspace, stdout=subprocess.DEVNULL, check=True)
+        commands = [
+            ('python (interpreter startup)', ['-c', 'pass']),
+            ('python (eager heavy imports)', ['-c', 'import %s' % ', '.join(HEAVY_MODULES)]),
+            ('cached lookup, no match', ['pcs-where-is.py', 'No Such Customer', '--cache']),
+            ('cached lookup, match', ['pcs-where-is.py', customer, '--cache']),
+            ('cached lookup, match, --users', ['pcs-where-is.py', customer, '--cache', '--users']),
+        ]
+        output('%-*s %10s  %s' % (32, 'Command', 'Seconds', 'Heavy modules imported (cumulative import seconds)'))
+        for description, command in commands:
+            elapsed, imported = time_command(command, workspace, args.runs)
+            output('%-*s %10.3f  %s' % (32, description, elapsed, ', '.join('%s: %.3f' % item for item in sorted(imported.items())) or 'none'))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+        server.shutdown()
@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import os
-import re
-import requests
+import signal
 import sys
 import time
 
-from datetime import datetime, timedelta
+from datetime import datetime
+
+from pcs_client import APIError, StackClient
 
 ##########################################################################################
 # Process arguments / parameters.
@@ -31,69 +31,64 @@ pc_parser.add_argument(
     '-d', '--debug',
     action='store_true',
     help='(Optional) Enable debugging')
+pc_parser.add_argument(
+    '--watch',
+    default=None,
+    type=float,
+    metavar='INTERVAL',
+    help='(Optional) Poll all stacks every INTERVAL seconds, outputting only version changes')
 
 args = pc_parser.parse_args()
 
+if args.watch is not None and args.watch <= 0:
+    pc_parser.error('--watch INTERVAL must be greater than 0')
+
 DEBUG_MODE = args.debug
 
 ##########################################################################################
 # Helpers.
 ##########################################################################################
 
-def output(output_data=''):
-    print(output_data)
+def handler(_signum, _frame):
+    print()
+    sys.exit(1)
 
-##########################################################################################
-# Helpers.
-##########################################################################################
+signal.signal(signal.SIGINT, handler)
 
-def login(login_url, access_key, secret_key, ca_bundle):
-    action = 'POST'
-    url = '%s/login' % login_url
-    headers = {'Content-Type': 'application/json'}
-    requ_data = json.dumps({'username': access_key, 'password': secret_key})
-    api_response = requests.request(action, url, headers=headers, data=requ_data, verify=ca_bundle)
-    if api_response.ok:
-        api_response = json.loads(api_response.content)
-        token = api_response.get('token')
-    else:
-        output('API (%s) responded with an error\n%s' % (url, api_response.text))
-        sys.exit(1)
-    if DEBUG_MODE:
-        output(action)
-        output(url)
-        output(requ_data)
-        output(api_response)
-        # output(token)
-        output()
-    return token
-
-def execute(action, url, token, ca_bundle=None, requ_data=None):
-    headers = {'Content-Type': 'application/json'}
-    headers['x-redlock-auth'] = token
-    api_response = requests.request(action, url, headers=headers, data=requ_data, verify=ca_bundle)
-    result = None
-    if api_response.status_code in [401, 429, 500, 502, 503, 504]:
-        for _ in range(1, 3):
-            time.sleep(16)
-            api_response = requests.request(action, url, headers=headers, verify=ca_bundle, data=requ_data)
-            if api_response.ok:
-                break # retry loop
-    if DEBUG_MODE:
-        output(action)
-        output(url)
-        output(requ_data)
-        output(api_response.status_code)
-        # output(api_response.text)
-        output()
-    if api_response.ok:
-        try:
-            result = json.loads(api_response.content)
-        except ValueError:
-            output('API (%s) responded with an error\n%s' % (endpoint, api_response.content))
-            sys.exit(1)
-    return result
+def output(output_data=''):
+    print(output_data)
 
+def timestamp():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def get_version(client):
+    """ Return the version of a stack (or None), and the time taken (in seconds) to get it. """
+    start_time = time.perf_counter()
+    try:
+        version = client.execute('GET', '/version')
+    except (APIError, OSError) as ex:
+        # An API or network error (or timeout, after REQUEST_TIMEOUT): when watching, the next poll may succeed.
+        if DEBUG_MODE:
+            output('Error connecting to %s: %s' % (client.url, ex))
+        version = None
+    return (version, time.perf_counter() - start_time)
+
+def watch_versions(clients, interval):
+    """ Poll all stacks concurrently every interval seconds, reusing their sessions and tokens, and output version changes. """
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ThreadPoolExecutor
+    versions = {}
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        while True:
+            poll_time = time.monotonic()
+            for client, (version, latency) in zip(clients, executor.map(get_version, clients)):
+                if client.name not in versions:
+                    output('%s %s %s (%.3f seconds)' % (timestamp(), client.url, version, latency))
+                elif version != versions[client.name]:
+                    output('%s %s %s -> %s (%.3f seconds)' % (timestamp(), client.url, versions[client.name], version, latency))
+                versions[client.name] = version
+            sys.stdout.flush()
+            time.sleep(max(0, interval - (time.monotonic() - poll_time)))
 
 ##########################################################################################
 ## Main.
@@ -129,15 +124,22 @@ if args.stack:
 if args.ca_bundle:
     CONFIG['CA_BUNDLE'] = args.ca_bundle
 
-
-
-
+# One client per stack, reusing its session and token across polls.
+clients = []
 for stack in CONFIG['STACKS']:
     if args.stack and args.stack.lower() != stack.lower():
         continue
     if CONFIG['STACKS'][stack]['access_key']:
-        token = login(CONFIG['STACKS'][stack]['url'], CONFIG['STACKS'][stack]['access_key'], CONFIG['STACKS'][stack]['secret_key'], CONFIG['CA_BUNDLE'])
-        
-        version = execute('GET', '%s/version' % CONFIG['STACKS'][stack]['url'], token, CONFIG['CA_BUNDLE'])
-        output('%s %s' % (CONFIG['STACKS'][stack]['url'], version))
+        clients.append(StackClient(stack, CONFIG['STACKS'][stack]['url'], CONFIG['STACKS'][stack]['access_key'], CONFIG['STACKS'][stack]['secret_key'], CONFIG['CA_BUNDLE'], DEBUG_MODE, retries=CONFIG.get('RETRIES', 4), timeout=CONFIG.get('REQUEST_TIMEOUT', 60)))
+
+if args.watch:
+    watch_versions(clients, args.watch)
+
+# Stacks are queried in parallel, but output in configuration order.
+# pylint: disable=import-outside-toplevel
+from concurrent.futures import ThreadPoolExecutor
+with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+    for client, (version, _) in zip(clients, executor.map(get_version, clients)):
+        output('%s %s' % (client.url, version))
+
                
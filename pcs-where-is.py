@@ -3,21 +3,19 @@
 """ Where? """
 
 import argparse
+import itertools
 import json
 import os
-import re
 import signal
+import sqlite3
 import sys
+import threading
 import time
 
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime, timedelta, timezone
 
-import requests
-
-from dateutil.tz import gettz
-
-# pylint: disable=import-error
-import arrow
+from pcs_client import NOT_MODIFIED, PROFILER, APIError, ResponseCache, StackClient
 
 ##########################################################################################
 # Process arguments / parameters.
@@ -27,8 +25,9 @@ pc_parser = argparse.ArgumentParser(description='Where is this Tenant? Who are i
 
 pc_parser.add_argument(
     'customer_name',
+    nargs='?',
     type=str,
-    help='*Required* Customer Name, or filename containg a (JSON) array of Customer Names')
+    help='*Required* Customer Name, or filename containg a (JSON) array of Customer Names (unless --serve)')
 pc_parser.add_argument(
     '--ca_bundle',
     default=os.environ.get('CA_BUNDLE', None),
@@ -42,7 +41,7 @@ pc_parser.add_argument(
 pc_parser.add_argument(
     '-c', '--cache',
     action='store_true',
-    help='(Optional) Cache responses from the API (eight hour lifetime)')
+    help='(Optional) Cache tenant lists from the API (Default lifetime: eight hours)')
 pc_parser.add_argument(
     '-d', '--debug',
     action='store_true',
@@ -56,183 +55,1156 @@ pc_parser.add_argument(
     default='name',
     choices=['login', 'name'],
     help="(Optional) Sort tenant users by login or name (Default: 'name')")
+pc_parser.add_argument(
+    '--users_export',
+    default=None,
+    type=str,
+    help='(Optional) Export users to a CSV (.csv) or JSON file, instead of outputting them (implies --users)')
+pc_parser.add_argument(
+    '--format',
+    default='text',
+    choices=['text', 'jsonl', 'csv'],
+    help="(Optional) Output one JSON Lines or CSV record per matching tenant, instead of text (Default: 'text')")
 pc_parser.add_argument(
     '-l', '--licensing',
     action='store_true',
     help='(Optional) Detailed licensing info')
+pc_parser.add_argument(
+    '-w', '--workers',
+    default=1,
+    type=int,
+    help='(Optional) Number of stacks to query in parallel (Default: 1, sequential)')
+pc_parser.add_argument(
+    '--profile',
+    action='store_true',
+    help='(Optional) Output a summary of the duration of API requests and other operations')
+pc_parser.add_argument(
+    '--profile_json',
+    default=None,
+    type=str,
+    help='(Optional) Also write the profile summary to this (JSON) file')
+pc_parser.add_argument(
+    '--detail_workers',
+    default=4,
+    type=int,
+    help='(Optional) Number of tenant usage, licensing, and user requests to run in parallel per stack (Default: 4)')
+pc_parser.add_argument(
+    '--first_match', '--first-match',
+    action='store_true',
+    help='(Optional) Stop searching other stacks once every customer is found by exact ID (prismaId, tenantId, or serialNumber)')
+pc_mode = pc_parser.add_mutually_exclusive_group()
+pc_mode.add_argument(
+    '--serve',
+    action='store_true',
+    help='(Optional) Run as a server, keeping tokens and tenant lists in memory, and answering lookups from --client')
+pc_mode.add_argument(
+    '--client',
+    action='store_true',
+    help='(Optional) Send the lookup to a server started with --serve')
+pc_parser.add_argument(
+    '--address',
+    default=None,
+    type=str,
+    help="(Optional) Server address, as host:port (Default: SERVER_ADDRESS in the config file, or '127.0.0.1:8765')")
+# Started by a lookup (with --stack) to refresh an expired cached tenant list, in the background.
+pc_parser.add_argument(
+    '--refresh',
+    action='store_true',
+    help=argparse.SUPPRESS)
 args = pc_parser.parse_args()
 
+if args.refresh:
+    if not args.stack:
+        pc_parser.error('--refresh requires --stack')
+    args.cache = True
+elif not args.customer_name and not args.serve:
+    pc_parser.error('customer_name is required')
+if args.users_export:
+    if args.serve or args.client:
+        pc_parser.error('--users_export is not supported with --serve or --client')
+    if args.format != 'text':
+        pc_parser.error('--users_export is not supported with --format jsonl or csv')
+    args.users = True
+if args.workers < 1:
+    pc_parser.error('--workers must be at least 1')
+if args.detail_workers < 1:
+    pc_parser.error('--detail_workers must be at least 1')
+
 DEBUG_MODE = args.debug
 
+PROFILER.enabled = args.profile or bool(args.profile_json)
+
 ##########################################################################################
 # Helpers.
 ##########################################################################################
 
 def handler(_signum, _frame):
     print()
-    sys.exit(1)
+    # Exit now, rather than (as sys.exit() would) waiting for the threads of stack downloads and detail requests in progress.
+    sys.stdout.flush()
+    os._exit(1)  # pylint: disable=protected-access
 
 signal.signal(signal.SIGINT, handler)
 
+# When set (by the server) output and warnings are collected here, per thread, rather than printed.
+OUTPUT = threading.local()
+
 def output(output_data=''):
-    print(output_data)
+    lines = getattr(OUTPUT, 'lines', None)
+    if lines is None:
+        print(output_data)
+    else:
+        lines.append(str(output_data))
+
+def warn(warning):
+    warnings = getattr(OUTPUT, 'warnings', None)
+    if warnings is None:
+        sys.stderr.write('%s\n' % warning)
+    else:
+        warnings.append(str(warning))
+
+def output_status(status_data=''):
+    """ Output a status (or debugging, or error) message: to standard error when outputting records, to keep them machine-readable. """
+    if args.format == 'text':
+        output(status_data)
+    else:
+        warn(status_data)
 
 ##########################################################################################
 # Helpers.
 ##########################################################################################
 
-def login(login_url, access_key, secret_key, ca_bundle):
-    action = 'POST'
-    url = '%s/login' % login_url
-    headers = {'Content-Type': 'application/json'}
-    requ_data = json.dumps({'username': access_key, 'password': secret_key})
-    api_response = requests.request(action, url, headers=headers, data=requ_data, verify=ca_bundle)
-    auth_token = None
-    if api_response.ok:
-        api_response = json.loads(api_response.content)
-        auth_token = api_response.get('token')
-    else:
-        output('API (%s) responded with an error\n%s' % (url, api_response.text))
-    if DEBUG_MODE:
-        output(action)
-        output(url)
-        output(requ_data)
-        output(api_response)
-        # output(auth_token)
-        output()
-    return auth_token
-
-def execute(action, url, auth_token, ca_bundle=None, requ_data=None):
-    headers = {'Content-Type': 'application/json'}
-    headers['x-redlock-auth'] = auth_token
-    api_response = requests.request(action, url, headers=headers, data=requ_data, verify=ca_bundle)
-    result = None
-    if api_response.status_code in [401, 429, 500, 502, 503, 504]:
-        output('Exceptional API response code %d received from %s. Waiting and then retrying' % (api_response.status_code, url))
-        for _ in range(1, 3):
-            time.sleep(16)
-            api_response = requests.request(action, url, headers=headers, verify=ca_bundle, data=requ_data)
-            if api_response.ok:
-                break # retry loop
-    if api_response.status_code == 403:
-        output('403 Unauthorized: check that credentials are valid and are authorized to access the API.')
-        return result
-    if DEBUG_MODE:
-        output(action)
-        output(url)
-        output(requ_data)
-        output(api_response.status_code)
-        # output(api_response.text)
-        output()
-    if api_response.ok:
-        try:
-            result = json.loads(api_response.content)
-        except ValueError:
-            output('API (%s) responded with an error\n%s' % (url, api_response.content))
-            sys.exit(1)
-    return result
+# Default lifetimes (in minutes) of cached responses: override them with RESPONSE_TTL in the config file.
+RESPONSE_TTL = {'day': 15, 'month': 60, 'year': 360, 'licensing': 60, 'users': 15}
+
+def response_ttl(response):
+    """ Lifetime (in seconds) of a cached response ('day', 'month', 'year', 'licensing', or 'users'). """
+    return CONFIG.get('RESPONSE_TTL', {}).get(response, RESPONSE_TTL[response]) * 60
 
-def define_usage(url, auth_token, ca_bundle, tenant, range):
+def get_usage(client, tenant, range):
     usage_query = json.dumps({'customerName': tenant['customerName'], 'timeRange': {'type':'relative','value': {'amount': 1,'unit': range}}})
-    usage = execute('POST', '%s/_support/license/api/v1/usage/time_series' % url, auth_token, ca_bundle, usage_query)
+    return client.execute('POST', '/_support/license/api/v1/usage/time_series', usage_query, response_ttl(range))
+
+def get_details(client, tenant, options):
+    """ Request the (independent) usage, licensing and user details of a tenant concurrently, returning futures. """
+    details = {}
+    for range in ['day', 'month', 'year']:
+        details[range] = client.submit(get_usage, client, tenant, range)
+    if options.licensing:
+        vcg_dspm = {"customerName":"","accountIds":[],"accountGroupIds":[],"timeRange":{"type":"relative","value":{"amount":"3","unit":"month"}},"cloudTypes":["gcp","others","oci","azure","aws","alibaba_cloud","ibm","repositories"]}
+        vcg_dspm['customerName'] = tenant['customerName']
+        details['licensing_page'] = client.submit(client.execute_all_pages, 'POST', '/_support/license/api/v2/usage', vcg_dspm, 'pageToken', response_ttl('licensing'))
+        licensing_query = {"customerName":"","timeRange":{"type":"relative","value":{"amount":"3","unit":"month"}},"cloud.type":["gcp","others","oci","azure","aws","alibaba_cloud","ibm"]}
+        licensing_query['customerName'] = tenant['customerName']
+        details['license_info'] = client.submit(client.execute, 'POST', '/_support/license', json.dumps(licensing_query), response_ttl('licensing'))
+    if options.users:
+        details['users'] = client.submit(client.execute, 'POST', '/v2/_support/user', json.dumps({'customerName': tenant['customerName']}), response_ttl('users'))
+    return details
+
+def define_usage(usage, range):
     if DEBUG_MODE:
         output(json.dumps(usage, indent=4))
+    current_usage_count = usage_snapshot(usage)
+    if current_usage_count is not None:
+        output('\tCredit snapshot, end of period (%s):  %s' % (range,current_usage_count))
+
+def usage_snapshot(usage):
+    """ Return the credits used at the end of the period of a usage time series, or None. """
     if usage and 'dataPoints' in usage and len(usage['dataPoints']) > 0:
         current_usage = usage['dataPoints'][-1]
         if 'counts' in current_usage and len(current_usage['counts']) > 0:
-            current_usage_count = sum(sum(c.values()) for c in current_usage['counts'].values())
-            output('\tCredit snapshot, end of period (%s):  %s' % (range,current_usage_count))
+            return sum(sum(c.values()) for c in current_usage['counts'].values())
+    return None
+
+def license_type(license_info):
+    """ Return the (friendly) active license type, or None. """
+    if license_info and license_info['activePlanType']:
+        if (license_info['activePlanType'] == 'RS_STANDARD'):
+            return 'Standard / A la carte'
+        if (license_info['activePlanType'] == 'RS_FOUNDATION'):
+            return 'Foundations bundle'
+        if (license_info['activePlanType'] == 'RS_ADVANCED'):
+            return 'Advanced bundle'
+        return 'Unknown (%s)' % license_info['activePlanType']
+    return None
 
-def find_customer(stack_name, tenant_list, customer_name, url, ca_bundle, auth_token):
+def find_customer(client, tenants, customer_name, options):
+    with PROFILER.timer('find_customer', client.name):
+        return output_customer(client, tenants, customer_name, options)
+
+def output_customer(client, tenants, customer_name, options):
     count = 0
-    if not tenant_list:
+    if tenants is None:
         return count
-    customer_name_lower = customer_name.lower()
-    for tenant in tenant_list:
-        customer_lower = tenant['customerName'].lower()
-        prisma_id = str(tenant['prismaId'])
-        if tenant['licenseDetails']['marketplaceData'] is not None:
-            tenant_id = str(tenant['licenseDetails']['marketplaceData']['tenantId'])
-            serial_num = str(tenant['licenseDetails']['marketplaceData']['serialNumber'])
-        if customer_name_lower in customer_lower or customer_name_lower in prisma_id or customer_name_lower in tenant_id or customer_name_lower in serial_num:
-            output('%s found on %s as %s' % (customer_name, stack_name, tenant['customerName']))
-            if DEBUG_MODE:
-                output(json.dumps(tenant, indent=4))
-            output('\tCustomer ID:   %s' % tenant['customerId'])
-            if 'marketplaceData' in tenant['licenseDetails'] and tenant['licenseDetails']['marketplaceData']:
-                if 'serialNumber' in tenant['licenseDetails']['marketplaceData']:
-                    output('\tSerial Number: %s' % tenant['licenseDetails']['marketplaceData']['serialNumber'])
-                if 'tenantId' in tenant['licenseDetails']['marketplaceData']:
-                    output('\tTenant ID:     %s' % tenant['licenseDetails']['marketplaceData']['tenantId'])
-                if 'endTs' in tenant['licenseDetails'] and tenant['licenseDetails']['endTs']:
-                    end_dt = datetime.fromtimestamp(tenant['licenseDetails']['endTs']/1000.0)
-                    output('\tRenewal Date:  %s' % end_dt)
-            output('\tPrisma ID:     %s' % tenant['prismaId'])
-            output('\tEval:          %s' % tenant['eval'])
-            output('\tActive:        %s' % tenant['active'])
-            output('\tCredits Available:       %s' % tenant['workloads'])
-            define_usage(url, auth_token, ca_bundle, tenant, "day")
-            define_usage(url, auth_token, ca_bundle, tenant, "month")
-            define_usage(url, auth_token, ca_bundle, tenant, "year")
-
-            output()
-            if args.licensing:
-                vcg_dspm = {"customerName":"","accountIds":[],"accountGroupIds":[],"timeRange":{"type":"relative","value":{"amount":"3","unit":"month"}},"cloudTypes":["gcp","others","oci","azure","aws","alibaba_cloud","ibm","repositories"]}
-                vcg_dspm['customerName'] = tenant['customerName']
-                vcg_dspm_query = json.dumps(vcg_dspm)
-                licensing_page = execute('POST', '%s/_support/license/api/v2/usage' % url, auth_token, ca_bundle, vcg_dspm_query)
-                output('License Usage Detail')
-                output('--------------------')
-                if licensing_page and licensing_page['stats'] and len(licensing_page['stats']) > 1:
-                    if DEBUG_MODE:
-                        output(json.dumps(licensing_page['stats'], indent=4))
-                    if licensing_page['nextPageToken'] is not None:
-                        output('WARN: Additional page not pulled. Please file an issue on github.')
-                    friendly_names = {'data_store': 'DSPM', 'iac': 'Infrastructure as Code', 'total': 'Total', 'ccs_secret_scanning': 'Secret scanning', 'serverless': 'Serverless', 'foundation': 'Foundations bundle', 'ccs_sca': 'SCA', 's3': 'Old DLP (AWS)', 'iaas': 'CSPM', 'iam': 'CIEM', 'cdem': 'CDEM',  'agentless_host': 'Agentless host scanning', 'host': 'Host security', 'container': 'Container security', 'cas_cicd_security': 'CI/CD security', 'ccs_iac_developer': 'Infrastructure as code', 'azure_blob_storage': 'Old DLP (Azure)', 'waas': 'WAAS', 'agentless_container': 'Agentless container scanning', 'advanced': 'Advanced bundle', 'container_caas': 'Containers as a Service security', 'serverless_function_scans':'Serverless Function Scans'}
-                    output(f"{friendly_names['total']:<32}{licensing_page['stats']['total']:>7}")
-                    for key, value in licensing_page['stats'].items():
-                        if value > 0 and key != 'total':
-                            output(f"{friendly_names[key]:<32}{value:>7}")
-                    licensing_query = {"customerName":"","timeRange":{"type":"relative","value":{"amount":"3","unit":"month"}},"cloud.type":["gcp","others","oci","azure","aws","alibaba_cloud","ibm"]}
-                    licensing_query['customerName'] = tenant['customerName']
-                    license_info = execute('POST', '%s/_support/license' % url, auth_token, ca_bundle, json.dumps(licensing_query))
-                    if license_info and license_info['activePlanType']:
-                        if (license_info['activePlanType'] == 'RS_STANDARD'):
-                            license_type = 'Standard / A la carte'
-                        elif (license_info['activePlanType'] == 'RS_FOUNDATION'):
-                            license_type = 'Foundations bundle'
-                        elif (license_info['activePlanType'] == 'RS_ADVANCED'):
-                            license_type = 'Advanced bundle'
-                        else:
-                            license_type = 'Unknown (%s)' % license_info['activePlanType']
-                        output('\nActive License Type: %s' % license_type)
-                    output('')
-                else:
-                    output('WARN: No license data for tenant\n')
-
-            if args.users:
-                users_query = json.dumps({'customerName': tenant['customerName']})
-                users = execute('POST', '%s/v2/_support/user' % url, auth_token, ca_bundle, users_query)
-                if DEBUG_MODE:
-                    output(json.dumps(users, indent=4))
-                if users:
-                    output('%-*s\t\t%-*s\t\t%s' % (25, 'Name', 33, 'Email Address', 'Last Login'))
-                    output('%-*s\t\t%-*s\t\t%s' % (25, '----', 33, '-------------', '----------'))
-                    if args.sort == 'login':
-                        users = sorted(users, key=lambda u: u['lastLoginTs'], reverse=True)
-                    for user in users:
-                        last_login = ''
-                        time_zone = gettz(user['timeZone'])
-                        if user['lastLoginTs'] == -1:
-                            last_login = 'Never'
-                        else:
-                            arrow_time = arrow.Arrow.fromtimestamp(user['lastLoginTs']/1000, time_zone)
-                            last_login = '%s - %s' % (arrow_time.format('YYYY-MM-DD'), arrow_time.humanize())
-                        output('%-*s\t\t%-*s\t\t%s' % (25, user['displayName'], 33, user['email'], last_login))
+    # Request the details of all matching tenants up front, then output them in order.
+    tenants_details = [get_details(client, tenant, options) for tenant in tenants]
+    for tenant, details in zip(tenants, tenants_details):
+        if options.records:
+            options.records.write(tenant_record(client, tenant, customer_name, details, options))
             count += 1
-    output()
+            continue
+        output('%s found on %s as %s' % (customer_name, client.name, tenant['customerName']))
+        if DEBUG_MODE:
+            output(json.dumps(tenant, indent=4))
+        output('\tCustomer ID:   %s' % tenant['customerId'])
+        if 'marketplaceData' in tenant['licenseDetails'] and tenant['licenseDetails']['marketplaceData']:
+            if 'serialNumber' in tenant['licenseDetails']['marketplaceData']:
+                output('\tSerial Number: %s' % tenant['licenseDetails']['marketplaceData']['serialNumber'])
+            if 'tenantId' in tenant['licenseDetails']['marketplaceData']:
+                output('\tTenant ID:     %s' % tenant['licenseDetails']['marketplaceData']['tenantId'])
+            if 'endTs' in tenant['licenseDetails'] and tenant['licenseDetails']['endTs']:
+                end_dt = datetime.fromtimestamp(tenant['licenseDetails']['endTs']/1000.0)
+                output('\tRenewal Date:  %s' % end_dt)
+        output('\tPrisma ID:     %s' % tenant['prismaId'])
+        output('\tEval:          %s' % tenant['eval'])
+        output('\tActive:        %s' % tenant['active'])
+        output('\tCredits Available:       %s' % tenant['workloads'])
+        define_usage(details['day'].result(), "day")
+        define_usage(details['month'].result(), "month")
+        define_usage(details['year'].result(), "year")
+
+        output()
+        if options.licensing:
+            licensing_page = details['licensing_page'].result()
+            output('License Usage Detail')
+            output('--------------------')
+            if licensing_page and licensing_page['stats'] and len(licensing_page['stats']) > 1:
+                if DEBUG_MODE:
+                    output(json.dumps(licensing_page['stats'], indent=4))
+                friendly_names = {'data_store': 'DSPM', 'iac': 'Infrastructure as Code', 'total': 'Total', 'ccs_secret_scanning': 'Secret scanning', 'serverless': 'Serverless', 'foundation': 'Foundations bundle', 'ccs_sca': 'SCA', 's3': 'Old DLP (AWS)', 'iaas': 'CSPM', 'iam': 'CIEM', 'cdem': 'CDEM',  'agentless_host': 'Agentless host scanning', 'host': 'Host security', 'container': 'Container security', 'cas_cicd_security': 'CI/CD security', 'ccs_iac_developer': 'Infrastructure as code', 'azure_blob_storage': 'Old DLP (Azure)', 'waas': 'WAAS', 'agentless_container': 'Agentless container scanning', 'advanced': 'Advanced bundle', 'container_caas': 'Containers as a Service security', 'serverless_function_scans':'Serverless Function Scans'}
+                output(f"{friendly_names['total']:<32}{licensing_page['stats']['total']:>7}")
+                for key, value in licensing_page['stats'].items():
+                    if value > 0 and key != 'total':
+                        output(f"{friendly_names[key]:<32}{value:>7}")
+                active_license_type = license_type(details['license_info'].result())
+                if active_license_type:
+                    output('\nActive License Type: %s' % active_license_type)
+                output('')
+            else:
+                output('WARN: No license data for tenant\n')
+
+        if options.users:
+            users = details['users'].result()
+            if DEBUG_MODE:
+                output(json.dumps(users, indent=4))
+            if users:
+                with PROFILER.timer('output users', client.name):
+                    output_users(client, tenant, users, options)
+        count += 1
+    if not options.records:
+        output()
     return count
 
+def search_stacks(clients, matcher, store, routes, options):
+    """ Return the (authenticated, matches) result of each stack, or None for each stack that did not need to be searched. """
+    results = [None] * len(clients)
+    routed = routes.route(matcher.names) if routes else None
+    if routed:
+        # Exact IDs seen before are searched for on their stack, and on the other stacks only if not found there.
+        if DEBUG_MODE:
+            output_status('Routing to: %s' % ', '.join(sorted(routed)))
+        search_stack_list(clients, [index for index, client in enumerate(clients) if client.name in routed], matcher, store, routes, options, results)
+        if found_exact(matcher.names, results):
+            return results
+    search_stack_list(clients, [index for index, result in enumerate(results) if result is None], matcher, store, routes, options, results)
+    return results
+
+def search_stack_list(clients, indexes, matcher, store, routes, options, results):
+    # With --first-match, the remaining stacks are not searched (and searches in progress are stopped) once every customer is found by exact ID.
+    stop = threading.Event() if options.first_match else None
+    # Stacks are queried in parallel (when workers > 1), but results are output in configuration order.
+    if options.workers > 1:
+        # pylint: disable=import-outside-toplevel
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        with ThreadPoolExecutor(max_workers=options.workers) as executor:
+            futures = {executor.submit(get_stack_matches, clients[index], matcher, store, routes, stop): index for index in indexes}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if stop and found_exact(matcher.names, results):
+                    stop.set()
+                    for other_future in futures:
+                        other_future.cancel()
+                    break
+    else:
+        for index in indexes:
+            results[index] = get_stack_matches(clients[index], matcher, store, routes, stop)
+            if stop and found_exact(matcher.names, results):
+                break
+
+def found_exact(names, results):
+    """ Return whether every name is the exact ID of a tenant matched on any stack. """
+    for name in names:
+        name_id = name.lower()
+        if not any(result and result[1] and any(name_id in tenant_ids(tenant) for tenant in result[1][name]) for result in results):
+            return False
+    return True
+
+def until_stopped(tenants, stop):
+    for tenant in tenants:
+        if stop.is_set():
+            return
+        yield tenant
+
+def get_stack_matches(client, matcher, store, routes=None, stop=None):
+    with PROFILER.timer('get_stack_matches', client.name):
+        return load_stack_matches(client, matcher, store, routes, stop)
+
+def load_stack_matches(client, matcher, store, routes=None, stop=None):
+    cache_age = store.age(client.name) if store else None
+    if cache_age is not None and cache_age < cache_ttl(client.name):
+        if DEBUG_MODE:
+            output_status('Reading cached stack tenants: %s' % client.name)
+        return (True, store.match(client.name, matcher.names))
+    if cache_age is not None and cache_age < cache_ttl(client.name) + CONFIG.get('CACHE_STALE_TTL', 24) * 3600:
+        # Expired, but recent enough to be used while it is refreshed in the background (unless it is already being refreshed).
+        if store.claim_refresh(client.name):
+            if DEBUG_MODE:
+                output_status('Reading cached stack tenants, and refreshing them in the background: %s' % client.name)
+            start_refresh(client.name, store)
+        elif DEBUG_MODE:
+            output_status('Reading cached stack tenants, already being refreshed in the background: %s' % client.name)
+        return (True, store.match(client.name, matcher.names))
+    if not client.login():
+        return (False, None)
+    # The tenant list is parsed, cached and matched one tenant at a time, as it is downloaded.
+    tenants = download_tenants(client, store, routes)
+    if tenants is None:
+        return (True, None)
+    if tenants is NOT_MODIFIED:
+        return (True, store.match(client.name, matcher.names))
+    if stop:
+        tenants = until_stopped(tenants, stop)
+    return (True, matcher.match(tenants))
+
+def cache_ttl(stack):
+    """ Lifetime (in seconds) of the cached tenant list of a stack. """
+    return CONFIG['STACKS'][stack].get('cache_ttl', CONFIG.get('CACHE_TTL', 8)) * 3600
+
+def download_tenants(client, store, routes=None):
+    """ Return a generator of the tenants of a stack, downloaded (and cached, and routed) as they are consumed, NOT_MODIFIED if the cached tenants are unchanged, or None. """
+    # The request is conditional on the (ETag or Last-Modified of the) cached tenant list, when the stack supports it.
+    validators = store.validators(client.name) if store else None
+    tenants = client.execute_stream('GET', '/_support/customer', validators=validators)
+    if tenants is NOT_MODIFIED:
+        if DEBUG_MODE:
+            output_status('Cached stack tenants unchanged: %s' % client.name)
+        store.touch(client.name)
+        return tenants
+    if tenants is not None and routes:
+        tenants = routes.record(client.name, tenants)
+    if tenants is not None and store:
+        if DEBUG_MODE:
+            output_status('Caching stack tenants: %s' % client.name)
+        tenants = store.save(client.name, tenants, validators)
+    return tenants
+
+def start_refresh(stack, store):
+    """ Refresh the cached tenant list of a stack in a separate (detached) process, so that neither the lookup nor its exit waits for it. """
+    # pylint: disable=import-outside-toplevel
+    import subprocess
+    command = [sys.executable, os.path.abspath(__file__), '--refresh', '--stack', stack]
+    if CONFIG.get('CA_BUNDLE'):
+        command.extend(['--ca_bundle', CONFIG['CA_BUNDLE']])
+    try:
+        # pylint: disable=consider-using-with
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as ex:
+        store.release_refresh(stack)
+        if DEBUG_MODE:
+            output_status('Error starting the refresh of %s: %s' % (stack, ex))
+
+def refresh_stack(client, store, routes=None):
+    """ Download (and cache, and route) the tenant list of a stack. """
+    if not client.login():
+        return
+    tenants = download_tenants(client, store, routes)
+    if tenants is not None and tenants is not NOT_MODIFIED:
+        deque(tenants, maxlen=0)
+
+def output_customers(customers, clients, stack_results, options):
+    """ Output the matching tenants of each customer, by stack, given the (authenticated, matches) result of each stack. """
+    # Records (with --format) are the only output: anything else is a warning.
+    output_warning = warn if options.records else output
+    for customer in customers:
+        found = 0
+        for client, stack_result in zip(clients, stack_results):
+            if stack_result is None:
+                continue
+            authenticated, matches = stack_result
+            if not options.records:
+                output('Checking: %s' % client.name)
+                output()
+            if not authenticated:
+                output_warning('Skipping %s because of authentication failure.' % client.name)
+                if not options.records:
+                    output()
+                continue
+            found += find_customer(client, matches[customer] if matches else None, customer, options)
+        if found == 0:
+            output_warning('%s not found on any configured stack' % customer)
+
+def read_customers(customer_name):
+    if os.path.isfile(customer_name):
+        with open(customer_name, 'r', encoding='utf8') as f:
+            return json.load(f)
+    return [customer_name]
+
+##########################################################################################
+# Records.
+##########################################################################################
+
+def tenant_record(client, tenant, customer_name, details, options):
+    """ Return the details of a matching tenant as a (flat, except for licenseUsage and users) record. """
+    marketplace_data = tenant['licenseDetails'].get('marketplaceData') or {}
+    end_ts = tenant['licenseDetails'].get('endTs')
+    record = {
+        'customer':     customer_name,
+        'stack':        client.name,
+        'customerName': tenant['customerName'],
+        'customerId':   tenant['customerId'],
+        'prismaId':     tenant['prismaId'],
+        'tenantId':     marketplace_data.get('tenantId'),
+        'serialNumber': marketplace_data.get('serialNumber'),
+        'renewalDate':  datetime.fromtimestamp(end_ts/1000.0, timezone.utc).isoformat() if end_ts else None,
+        'eval':         tenant['eval'],
+        'active':       tenant['active'],
+        'credits':      tenant['workloads'],
+        'usageDay':     usage_snapshot(details['day'].result()),
+        'usageMonth':   usage_snapshot(details['month'].result()),
+        'usageYear':    usage_snapshot(details['year'].result()),
+    }
+    if options.licensing:
+        licensing_page = details['licensing_page'].result()
+        record['licenseType'] = license_type(details['license_info'].result())
+        record['licenseUsage'] = licensing_page['stats'] if licensing_page else None
+    if options.users:
+        users = details['users'].result() or []
+        if options.sort == 'login':
+            users.sort(key=lambda u: u['lastLoginTs'], reverse=True)
+        record['users'] = [{'displayName': user['displayName'], 'email': user['email'], 'timeZone': user['timeZone'], 'lastLoginTs': user['lastLoginTs']} for user in users]
+    return record
+
+class RecordWriter():
+    """ Output records as JSON Lines, or as CSV (with nested values as JSON), one line per record. """
+
+    def __init__(self, record_format):
+        self.format = record_format
+        self.fields = None
+        if record_format == 'csv':
+            # pylint: disable=import-outside-toplevel
+            import csv
+            import io
+            self.buffer = io.StringIO()
+            self.writer = csv.writer(self.buffer, lineterminator='\n')
+
+    def write(self, record):
+        if self.format == 'jsonl':
+            output(json.dumps(record))
+            return
+        if self.fields is None:
+            self.fields = list(record)
+            self.writer.writerow(self.fields)
+        self.writer.writerow([json.dumps(record[field]) if isinstance(record[field], (dict, list)) else record[field] for field in self.fields])
+        output(self.buffer.getvalue().rstrip('\n'))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+##########################################################################################
+# Users.
+##########################################################################################
+
+def output_users(client, tenant, users, options):
+    if options.sort == 'login':
+        # Sorted in place: user lists can be large.
+        users.sort(key=lambda u: u['lastLoginTs'], reverse=True)
+    logins = LoginFormatter()
+    if options.user_export:
+        options.user_export.write(client.name, tenant, users, logins)
+        output('\t%s users exported to %s' % (len(users), options.user_export.file_name))
+        return
+    # Buffered, and output at once.
+    rows = ['%-*s\t\t%-*s\t\t%s' % (25, 'Name', 33, 'Email Address', 'Last Login'), '%-*s\t\t%-*s\t\t%s' % (25, '----', 33, '-------------', '----------')]
+    for user in users:
+        rows.append('%-*s\t\t%-*s\t\t%s' % (25, user['displayName'], 33, user['email'], logins.format(user['lastLoginTs'], user['timeZone'])))
+    output('\n'.join(rows))
+
+class LoginFormatter():
+    """ Format last login times as a date and a relative time (as arrow's humanize()), relative to one 'now', with time zones and descriptions cached. """
+
+    # The thresholds (in seconds) of humanize(), as of arrow 1.4 (pinned in requirements.txt).
+    SECONDS = {'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800, 'month': 2635200, 'year': 31536000}
+
+    # Differences (in seconds) either side of each threshold, checked against arrow's humanize() (see check()).
+    CHECKS = [0, 9, 10, 59, 60, 119, 120, 3599, 3600, 7199, 7200, 86399, 86400, 172799, 172800, 604799, 604800, 1209599, 1209600,
+              1296000, 2635199, 2635200, 5270400, 31535999, 31536000, 63071999, 63072000, 94608000]
+
+    def __init__(self):
+        # Imported here, as only user output needs them (and they are slow to import).
+        # pylint: disable=import-error,import-outside-toplevel
+        import arrow
+        from dateutil.relativedelta import relativedelta
+        from dateutil.tz import gettz, tzlocal
+        self.gettz = gettz
+        self.tzlocal = tzlocal
+        self.relativedelta = relativedelta
+        self.arrow = arrow
+        self.locale = arrow.locales.get_locale('en-us')
+        self.now = time.time()
+        self.zones = {}
+        self.descriptions = {}
+        self.exact = True
+        self.exact = self.check()
+
+    def check(self):
+        """ Return whether humanize() matches arrow's humanize(), which it falls back to if not (such as with a later version of arrow). """
+        now = datetime(2024, 1, 31, 12, 0, 0)
+        for seconds in self.CHECKS:
+            for login in [now - timedelta(seconds=seconds), now + timedelta(seconds=seconds)]:
+                if self.humanize(login, now) != self.arrow.Arrow.fromdatetime(login).humanize(self.arrow.Arrow.fromdatetime(now)):
+                    return False
+        return True
+
+    def zone(self, name):
+        """ Return the time zone, and the (naive) local time now, of a time zone name. """
+        if name not in self.zones:
+            time_zone = self.gettz(name) or self.tzlocal()
+            self.zones[name] = (time_zone, datetime.fromtimestamp(self.now, time_zone).replace(tzinfo=None))
+        return self.zones[name]
+
+    def local_time(self, timestamp, time_zone_name):
+        """ Return the (naive) local time of a timestamp (in milliseconds) in a time zone. """
+        return datetime.fromtimestamp(timestamp / 1000, self.zone(time_zone_name)[0]).replace(tzinfo=None)
+
+    def format(self, timestamp, time_zone_name):
+        if timestamp == -1:
+            return 'Never'
+        login = self.local_time(timestamp, time_zone_name)
+        return '%04d-%02d-%02d - %s' % (login.year, login.month, login.day, self.humanize(login, self.zone(time_zone_name)[1]))
+
+    def humanize(self, login, now):
+        # Both times are local to the same time zone, so (as in arrow) differences are in wall clock time.
+        if not self.exact:
+            return self.arrow.Arrow.fromdatetime(login).humanize(self.arrow.Arrow.fromdatetime(now))
+        delta = int(round((login - now).total_seconds()))
+        sign = -1 if delta < 0 else 1
+        diff = abs(delta)
+        if diff < 10:
+            timeframe, count = 'now', 0
+        elif diff < self.SECONDS['minute']:
+            timeframe, count = 'seconds', sign * diff
+        elif diff < self.SECONDS['minute'] * 2:
+            timeframe, count = 'minute', sign
+        elif diff < self.SECONDS['hour']:
+            timeframe, count = 'minutes', sign * max(diff // self.SECONDS['minute'], 2)
+        elif diff < self.SECONDS['hour'] * 2:
+            timeframe, count = 'hour', sign
+        elif diff < self.SECONDS['day']:
+            timeframe, count = 'hours', sign * max(diff // self.SECONDS['hour'], 2)
+        elif diff < self.SECONDS['day'] * 2:
+            timeframe, count = 'day', sign
+        elif diff < self.SECONDS['week']:
+            timeframe, count = 'days', sign * max(diff // self.SECONDS['day'], 2)
+        else:
+            calendar_diff = self.relativedelta(now, login) if login < now else self.relativedelta(login, now)
+            months = calendar_diff.years * 12 + calendar_diff.months + (1 if calendar_diff.days > 14 else 0)
+            months = min(months, 12)
+            if months >= 1 and diff < self.SECONDS['year']:
+                timeframe, count = ('month', sign) if months == 1 else ('months', sign * months)
+            elif diff < self.SECONDS['week'] * 2:
+                timeframe, count = 'week', sign
+            elif diff < self.SECONDS['month']:
+                timeframe, count = 'weeks', sign * max(diff // self.SECONDS['week'], 2)
+            elif diff < self.SECONDS['year'] * 2:
+                timeframe, count = 'year', sign
+            else:
+                timeframe, count = 'years', sign * max(diff // self.SECONDS['year'], 2)
+        if (timeframe, count) not in self.descriptions:
+            self.descriptions[(timeframe, count)] = self.locale.describe(timeframe, count)
+        return self.descriptions[(timeframe, count)]
+
+class UserExport():
+    """ Write the users of matching tenants to a CSV or JSON file, as each tenant is output. """
+
+    FIELDS = ['stack', 'customerName', 'prismaId', 'displayName', 'email', 'timeZone', 'lastLoginTs', 'lastLogin']
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # pylint: disable=consider-using-with
+        self.file = open(file_name, 'w', encoding='utf8', newline='')
+        self.writer = None
+        self.count = 0
+        if file_name.lower().endswith('.csv'):
+            # pylint: disable=import-outside-toplevel
+            import csv
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.FIELDS)
+        else:
+            self.file.write('[')
+
+    def write(self, stack, tenant, users, logins):
+        for user in users:
+            last_login = ''
+            if user['lastLoginTs'] != -1:
+                last_login = logins.local_time(user['lastLoginTs'], user['timeZone']).isoformat()
+            row = [stack, tenant['customerName'], tenant['prismaId'], user['displayName'], user['email'], user['timeZone'], user['lastLoginTs'], last_login]
+            if self.writer:
+                self.writer.writerow(row)
+            else:
+                self.file.write('%s\n%s' % (',' if self.count else '', json.dumps(dict(zip(self.FIELDS, row)))))
+            self.count += 1
+
+    def close(self):
+        if not self.writer:
+            self.file.write('\n]\n')
+        self.file.close()
+
+##########################################################################################
+# Matching.
+##########################################################################################
+
+def tenant_ids(tenant):
+    """ Lowercased prismaId, tenantId and serialNumber of a tenant (empty if it has no marketplace data). """
+    marketplace_data = tenant['licenseDetails'].get('marketplaceData') or {}
+    return (str(tenant['prismaId']).lower(), str(marketplace_data.get('tenantId', '')).lower(), str(marketplace_data.get('serialNumber', '')).lower())
+
+def tenant_search_text(tenant):
+    """ Lowercased searchable fields of a tenant, separated so that a match cannot span fields. """
+    return '\0'.join((tenant['customerName'].lower(),) + tenant_ids(tenant))
+
+class TenantMatcher():
+    """ Match every customer name (as a case-insensitive substring) against each tenant in a single pass. """
+
+    # Below this many distinct names, substring checks are faster than walking the automaton in Python.
+    AUTOMATON_THRESHOLD = 64
+
+    def __init__(self, names):
+        self.names = names
+        self.patterns = list(dict.fromkeys(name.lower() for name in names))
+        self.automaton = len(self.patterns) >= self.AUTOMATON_THRESHOLD
+        if self.automaton:
+            self.build_automaton()
+
+    def build_automaton(self):
+        # Aho-Corasick: a trie of the patterns, with failure links and (merged) output sets per state.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].add(index)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.out[next_state] |= self.out[self.fail[next_state]]
+
+    def search(self, text):
+        """ Return the indexes of the patterns found in text. """
+        if not self.automaton:
+            return [index for index, pattern in enumerate(self.patterns) if pattern in text]
+        found = set(self.out[0])
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.out[state]:
+                found |= self.out[state]
+        return found
+
+    def match(self, tenants):
+        """ Return the matching tenants, in tenant list order, for each customer name. """
+        return self.match_entries((tenant_search_text(tenant), tenant) for tenant in tenants)
+
+    def match_entries(self, entries):
+        """ As match(), given (search text, tenant) entries. """
+        results = [[] for _ in self.patterns]
+        for search_text, tenant in entries:
+            for index in self.search(search_text):
+                results[index].append(tenant)
+        by_pattern = dict(zip(self.patterns, results))
+        return {name: by_pattern[name.lower()] for name in self.names}
+
+class TenantIndex():
+    """ The tenants of a stack, held in memory with their search text extracted, for repeated lookups. """
+
+    def __init__(self, tenants):
+        self.entries = [(tenant_search_text(tenant), tenant) for tenant in tenants]
+
+    def match(self, names):
+        """ Return the matching tenants, in tenant list order, for each customer name (as TenantMatcher). """
+        return TenantMatcher(names).match_entries(self.entries)
+
+##########################################################################################
+# Cache.
+##########################################################################################
+
+class TenantStore():
+    """ Tenant lists, cached in a sqlite database, with the (lowercased) search text of each tenant. """
+
+    SCHEMA_VERSION = 9
+
+    SCHEMA = '''
+        DROP TABLE IF EXISTS stacks;
+        DROP TABLE IF EXISTS tenants;
+        DROP TABLE IF EXISTS staged;
+        DROP TABLE IF EXISTS generations;
+        DROP TABLE IF EXISTS refreshes;
+        CREATE TABLE stacks (
+            stack TEXT PRIMARY KEY,
+            updated REAL NOT NULL,
+            generation INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            etag TEXT,
+            last_modified TEXT
+        );
+        CREATE TABLE tenants (
+            stack TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            prisma_id TEXT,
+            search_text TEXT NOT NULL,
+            tenant TEXT NOT NULL,
+            digest TEXT NOT NULL
+        );
+        CREATE INDEX tenants_position ON tenants (stack, generation, position);
+        CREATE TABLE generations (
+            stack TEXT PRIMARY KEY,
+            reserved INTEGER NOT NULL
+        );
+        CREATE TABLE refreshes (
+            stack TEXT PRIMARY KEY,
+            started REAL NOT NULL
+        );
+    '''
+
+    # Tenants are saved in batches (of this many) so that a stack's tenant list is never held in memory.
+    BATCH_SIZE = 1000
+
+    # A background refresh that has not completed after this long (in seconds) is assumed to have failed.
+    REFRESH_TIMEOUT = 30 * 60
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, timeout=60, check_same_thread=False)
+        # Numbers the (temporary, per connection) staging table of each save_changes().
+        self.staged = itertools.count(1)
+        with self.lock, self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self.connection.executescript(self.SCHEMA)
+                self.connection.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+
+    def generation(self, stack):
+        row = self.connection.execute('SELECT generation FROM stacks WHERE stack = ?', (stack,)).fetchone()
+        return row[0] if row else 0
+
+    def age(self, stack):
+        """ Return the time (in seconds) since the tenant list of a stack was saved (or found unchanged), or None. """
+        with self.lock:
+            row = self.connection.execute('SELECT updated FROM stacks WHERE stack = ?', (stack,)).fetchone()
+        return time.time() - row[0] if row else None
+
+    def is_fresh(self, stack, ttl):
+        age = self.age(stack)
+        return age is not None and age < ttl
+
+    def validators(self, stack):
+        """ Return the ETag and Last-Modified of the saved tenant list of a stack, for a conditional request. """
+        with self.lock:
+            row = self.connection.execute('SELECT etag, last_modified FROM stacks WHERE stack = ?', (stack,)).fetchone()
+        return {'etag': row[0] if row else None, 'last_modified': row[1] if row else None}
+
+    def touch(self, stack):
+        """ Mark the saved tenant list of a stack as current (as it is unchanged). """
+        with PROFILER.timer('cache write'), self.lock, self.connection:
+            self.connection.execute('UPDATE stacks SET updated = ? WHERE stack = ?', (time.time(), stack))
+
+    def claim_refresh(self, stack):
+        """ Return whether this run may refresh the tenant list of a stack in the background, as no other refresh of it is running. """
+        now = time.time()
+        with PROFILER.timer('cache write'), self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO refreshes VALUES (?, 0)', (stack,))
+            return self.connection.execute('UPDATE refreshes SET started = ? WHERE stack = ? AND started < ?', (now, stack, now - self.REFRESH_TIMEOUT)).rowcount == 1
+
+    def release_refresh(self, stack):
+        with PROFILER.timer('cache write'), self.lock, self.connection:
+            self.connection.execute('UPDATE refreshes SET started = 0 WHERE stack = ?', (stack,))
+
+    def row(self, stack, generation, position, tenant):
+        # Imported here, as it is only needed when saving tenant lists.
+        # pylint: disable=import-outside-toplevel
+        import hashlib
+        tenant_json = json.dumps(tenant)
+        return (stack, generation, position, tenant_ids(tenant)[0], tenant_search_text(tenant), tenant_json, hashlib.blake2b(tenant_json.encode(), digest_size=16).hexdigest())
+
+    def save(self, stack, tenants, validators=None):
+        """ Replace the tenant list of a stack, yielding each tenant as it is saved. """
+        with PROFILER.timer('cache read'), self.lock:
+            saved_list = self.connection.execute('SELECT generation, revision FROM stacks WHERE stack = ?', (stack,)).fetchone()
+        if saved_list is None:
+            return self.save_generation(stack, tenants, validators)
+        return self.save_changes(stack, tenants, saved_list, validators)
+
+    def reserve_generation(self, stack):
+        """ Return a new generation number for the tenant list of a stack, unique across processes sharing the database. """
+        with PROFILER.timer('cache write'), self.lock, self.connection:
+            # Writing first (in the transaction) locks the database, so no other process can reserve the same number.
+            self.connection.execute('INSERT OR IGNORE INTO generations VALUES (?, 0)', (stack,))
+            self.connection.execute('UPDATE generations SET reserved = reserved + 1 WHERE stack = ?', (stack,))
+            return self.connection.execute('SELECT reserved FROM generations WHERE stack = ?', (stack,)).fetchone()[0]
+
+    def save_generation(self, stack, tenants, validators):
+        # The new tenant list is saved as a new generation, which replaces the current one (atomically) once complete.
+        generation = self.reserve_generation(stack)
+        rows = []
+        for position, tenant in enumerate(tenants):
+            rows.append(self.row(stack, generation, position, tenant))
+            if len(rows) == self.BATCH_SIZE:
+                self.insert('tenants', rows)
+                rows = []
+            yield tenant
+        self.insert('tenants', rows)
+        validators = validators or {}
+        with PROFILER.timer('cache write'), self.lock, self.connection:
+            # Unless a later generation (saved concurrently, by another run) has already replaced the current one.
+            self.connection.execute('INSERT OR IGNORE INTO stacks VALUES (?, 0, 0, 0, NULL, NULL)', (stack,))
+            replaced = self.connection.execute('''
+                UPDATE stacks SET updated = ?, generation = ?, revision = revision + 1, etag = ?, last_modified = ? WHERE stack = ? AND generation < ?
+            ''', (time.time(), generation, validators.get('etag'), validators.get('last_modified'), stack, generation)).rowcount
+            # Earlier generations include any abandoned (or still being saved) by other runs, which abandon them when complete.
+            self.connection.execute('DELETE FROM tenants WHERE stack = ? AND generation %s ?' % ('<' if replaced else '='), (stack, generation))
+        if DEBUG_MODE and not replaced:
+            output_status('Cached stack tenants already replaced by a later download: %s' % stack)
+
+    def save_changes(self, stack, tenants, saved_list, validators):
+        # Tenants are compared (in batches) with the current tenant at the same position, and only those that differ are staged,
+        # then compared (by prismaId) with the current generation, which is patched (atomically) once complete.
+        generation, revision = saved_list
+        # Each save stages its tenants in its own (temporary) table, so that concurrent saves (in this or other runs) cannot interfere.
+        staged = 'staged_%d' % next(self.staged)
+        with self.lock:
+            self.connection.execute('CREATE TEMP TABLE %s AS SELECT * FROM main.tenants WHERE 0' % staged)
+        try:
+            rows = []
+            count = 0
+            for position, tenant in enumerate(tenants):
+                rows.append(self.row(stack, generation, position, tenant))
+                count = position + 1
+                if len(rows) == self.BATCH_SIZE:
+                    self.stage(staged, rows)
+                    rows = []
+                yield tenant
+            self.stage(staged, rows)
+            validators = validators or {}
+            with PROFILER.timer('cache write'), self.lock, self.connection:
+                # Unless the tenant list has been saved (by another run) since it was read, as the changes are relative to it.
+                patched = self.connection.execute('''
+                    UPDATE stacks SET updated = ?, revision = revision + 1, etag = ?, last_modified = ? WHERE stack = ? AND revision = ?
+                ''', (time.time(), validators.get('etag'), validators.get('last_modified'), stack, revision)).rowcount
+                if patched:
+                    saved, moved, removed = self.patch(stack, generation, staged, count)
+        finally:
+            with self.lock:
+                self.connection.execute('DROP TABLE %s' % staged)
+        if DEBUG_MODE:
+            if patched:
+                output_status('Cached stack tenants changed: %s (%d saved, %d moved, %d replaced or removed)' % (stack, saved, moved, removed))
+            else:
+                output_status('Cached stack tenants already saved by another download: %s' % stack)
+
+    def stage(self, staged, rows):
+        """ Stage the rows (of consecutive positions) that differ from the current row at the same position. """
+        if not rows:
+            return
+        stack, generation, first = rows[0][:3]
+        with PROFILER.timer('cache read'), self.lock:
+            current = {row[0]: row[1:] for row in self.connection.execute('''
+                SELECT position, prisma_id, digest FROM tenants WHERE stack = ? AND generation = ? AND position BETWEEN ? AND ?
+            ''', (stack, generation, first, rows[-1][2]))}
+        rows = [row for row in rows if current.get(row[2]) != (row[3], row[-1])]
+        if rows:
+            self.insert(staged, rows)
+
+    def patch(self, stack, generation, staged, count):
+        """
+        Patch the current generation of the tenant list of a stack, of which the staged tenants differ, to match the (count) tenants downloaded,
+        identifying tenants by prismaId, and return the number of tenants saved, moved, and replaced or removed.
+        """
+        # The current tenants that may differ: those at the position of a staged tenant, and those beyond the end of the tenant list.
+        differ = 'stack = ? AND generation = ? AND (position IN (SELECT position FROM %s) OR position >= ?)' % staged
+        try:
+            self.connection.execute('CREATE UNIQUE INDEX temp.%s_prisma_id ON %s (prisma_id)' % (staged, staged))
+        except sqlite3.IntegrityError:
+            return self.replace(staged, differ, (stack, generation, count))
+        # Those that are unchanged, but moved (such as after an insertion or removal), are only renumbered,
+        # and those that are changed or removed are deleted (once renumbered to -1).
+        renumbered = self.connection.execute('''
+            UPDATE tenants SET position = coalesce((
+                SELECT position FROM %s AS staged WHERE staged.prisma_id = tenants.prisma_id AND staged.digest = tenants.digest
+            ), -1) WHERE %s
+        ''' % (staged, differ), (stack, generation, count)).rowcount
+        removed = self.connection.execute('DELETE FROM tenants WHERE stack = ? AND generation = ? AND position = -1', (stack, generation)).rowcount
+        # New and changed tenants are inserted.
+        saved = self.connection.execute('''
+            INSERT INTO tenants SELECT * FROM %s AS staged WHERE NOT EXISTS (
+                SELECT 1 FROM tenants WHERE stack = staged.stack AND generation = staged.generation AND position = staged.position
+            )
+        ''' % staged).rowcount
+        # Unless a prismaId is not unique in the current tenant list, and more than one tenant was renumbered to the same position.
+        if self.connection.execute('SELECT count(*) FROM tenants WHERE stack = ? AND generation = ?', (stack, generation)).fetchone()[0] != count:
+            return self.replace(staged, differ, (stack, generation, count))
+        return (saved, renumbered - removed, removed)
+
+    def replace(self, staged, differ, parameters):
+        """ Replace the current tenants that differ with the staged tenants, as they cannot be identified by a (unique) prismaId. """
+        removed = self.connection.execute('DELETE FROM tenants WHERE %s' % differ, parameters).rowcount
+        return (self.connection.execute('INSERT INTO tenants SELECT * FROM %s' % staged).rowcount, 0, removed)
+
+    def insert(self, table, rows):
+        with PROFILER.timer('cache write'), self.lock, self.connection:
+            self.connection.executemany('INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?)' % table, rows)
+
+    def tenants(self, stack):
+        """ Yield the cached tenants of a stack, in tenant list order. """
+        position = 0
+        while True:
+            with PROFILER.timer('cache read'), self.lock:
+                rows = self.connection.execute('''
+                    SELECT position, tenant FROM tenants WHERE stack = ? AND generation = ? AND position >= ? ORDER BY position LIMIT ?
+                ''', (stack, self.generation(stack), position, self.BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row[1])
+            position = rows[-1][0] + 1
+
+    def match(self, stack, names):
+        """ Return the matching tenants, in tenant list order, for each customer name. """
+        # The search text of the stack's tenants is matched (as a downloaded tenant list is) against all names in a single pass,
+        # and only the matching tenants are read.
+        matcher = TenantMatcher(names)
+        # With few names, sqlite also filters the search text (in the same pass) so that only candidate rows are matched in Python.
+        candidates = '' if matcher.automaton else 'AND (%s)' % ' OR '.join(['instr(search_text, ?) > 0'] * len(matcher.patterns))
+        with PROFILER.timer('cache read'), self.lock:
+            generation = self.generation(stack)
+            positions = matcher.match_entries(self.connection.execute('''
+                SELECT search_text, position FROM tenants WHERE stack = ? AND generation = ? %s ORDER BY position
+            ''' % candidates, (stack, generation) + (() if matcher.automaton else tuple(matcher.patterns))))
+            matched = sorted(set(itertools.chain.from_iterable(positions.values())))
+            tenants = {}
+            # In batches, within the (default) limit of 999 parameters per query of older versions of sqlite.
+            for batch in range(0, len(matched), 500):
+                batch_positions = matched[batch:batch + 500]
+                tenants.update(self.connection.execute('''
+                    SELECT position, tenant FROM tenants WHERE stack = ? AND generation = ? AND position IN (%s)
+                ''' % ', '.join('?' * len(batch_positions)), (stack, generation) + tuple(batch_positions)))
+        return {name: [json.loads(tenants[position]) for position in name_positions] for name, name_positions in positions.items()}
+
+class RouteMap():
+    """ The stacks of the tenant IDs (prismaId, tenantId and serialNumber) seen in tenant lists, kept in a sqlite database between runs. """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS routes (
+            id TEXT NOT NULL,
+            stack TEXT NOT NULL,
+            PRIMARY KEY (id, stack)
+        );
+    '''
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, timeout=60, check_same_thread=False)
+        # Numbers the (temporary, per connection) staging table of each record().
+        self.staged = itertools.count(1)
+        with self.lock, self.connection:
+            # Routes saved by earlier versions (with an unused updated column) are dropped, and recorded again by the next download of each stack.
+            if 'updated' in [row[1] for row in self.connection.execute('PRAGMA table_info(routes)')]:
+                self.connection.execute('DROP TABLE routes')
+            self.connection.executescript(self.SCHEMA)
+
+    def record(self, stack, tenants):
+        """ Record the IDs of each tenant of a stack, yielding each tenant as it is recorded. """
+        # The IDs are staged (rather than held in memory), then new routes are added and removed ones deleted, once the list is complete.
+        staged = 'staged_routes_%d' % next(self.staged)
+        with self.lock:
+            self.connection.execute('CREATE TEMP TABLE %s (id TEXT NOT NULL)' % staged)
+        try:
+            rows = []
+            for tenant in tenants:
+                rows.extend((tenant_id,) for tenant_id in tenant_ids(tenant) if tenant_id)
+                if len(rows) >= self.BATCH_SIZE:
+                    self.insert(staged, rows)
+                    rows = []
+                yield tenant
+            self.insert(staged, rows)
+            with PROFILER.timer('routes write'), self.lock, self.connection:
+                # Between downloads, most IDs are unchanged: only new routes are written.
+                self.connection.execute('INSERT OR IGNORE INTO routes SELECT id, ? FROM %s' % staged, (stack,))
+                self.connection.execute('DELETE FROM routes WHERE stack = ? AND id NOT IN (SELECT id FROM %s)' % staged, (stack,))
+        finally:
+            with self.lock:
+                self.connection.execute('DROP TABLE %s' % staged)
+
+    def insert(self, staged, rows):
+        with PROFILER.timer('routes stage'), self.lock, self.connection:
+            self.connection.executemany('INSERT INTO %s VALUES (?)' % staged, rows)
+
+    def route(self, names):
+        """ Return the stacks of the tenants with these IDs, or None unless every name is a known ID. """
+        stacks = set()
+        with PROFILER.timer('routes read'), self.lock:
+            for name_id in dict.fromkeys(name.lower() for name in names):
+                rows = self.connection.execute('SELECT stack FROM routes WHERE id = ?', (name_id,)).fetchall()
+                if not rows:
+                    return None
+                stacks.update(row[0] for row in rows)
+        return stacks
+
+##########################################################################################
+# Server.
+##########################################################################################
+
+def load_stack_index(client, store, index=None):
+    """ Return an index of the tenants of a stack, from the cache if it is fresh (or unchanged), or None. """
+    try:
+        return read_stack_index(client, store, index)
+    # pylint: disable=broad-except
+    except Exception as ex:
+        # Such as a network error (or timeout), an API error, or a locked cache: the stack keeps its previous index, until the next refresh.
+        warn('Error refreshing %s: %s' % (client.name, ex))
+        return None
+
+def read_stack_index(client, store, index=None):
+    if store and store.is_fresh(client.name, cache_ttl(client.name)):
+        return TenantIndex(store.tenants(client.name))
+    if not client.login():
+        return None
+    tenants = download_tenants(client, store)
+    if tenants is None:
+        return None
+    if tenants is NOT_MODIFIED:
+        return index or TenantIndex(store.tenants(client.name))
+    return TenantIndex(tenants)
+
+def serve(clients, store, address, options):
+    """ Answer lookups (from query_server) using warm tokens and in-memory tenant indexes, refreshed in the background. """
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    indexes = {}
+
+    def refresh_indexes():
+        with ThreadPoolExecutor(max_workers=options.workers) as executor:
+            for client, index in zip(clients, executor.map(load_stack_index, clients, [store] * len(clients), [indexes.get(client.name) for client in clients])):
+                # Keep the previous index of a stack that (temporarily) fails to refresh.
+                if index is not None:
+                    indexes[client.name] = index
+                if DEBUG_MODE:
+                    output('Refreshed %s: %s tenants' % (client.name, len(index.entries) if index else 'failed,'))
+
+    def refresh_loop():
+        while True:
+            time.sleep(CONFIG.get('SERVER_REFRESH', 1) * 3600)
+            refresh_indexes()
+
+    class LookupHandler(BaseHTTPRequestHandler):
+        def log_message(self, *log_args):
+            if DEBUG_MODE:
+                super().log_message(*log_args)
+
+        def do_POST(self):
+            if self.path != '/lookup':
+                self.send_error(404)
+                return
+            try:
+                query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                record_format = query.get('format', 'text')
+                # Validate each parameter (as argparse does for a standalone lookup): a string of customers is not a list of customers.
+                if not isinstance(query['customers'], list) or not all(isinstance(customer, str) for customer in query['customers']):
+                    raise ValueError('customers')
+                if not isinstance(query.get('users', False), bool) or not isinstance(query.get('licensing', False), bool):
+                    raise ValueError('users, licensing')
+                if query.get('sort', 'name') not in ['login', 'name'] or record_format not in ['text', 'jsonl', 'csv']:
+                    raise ValueError('sort, format')
+                if not isinstance(query.get('stack') or '', str):
+                    raise ValueError('stack')
+            except (AttributeError, KeyError, TypeError, ValueError):
+                self.send_error(400, 'Expected a JSON object with a list of customers, and valid users, licensing, sort, stack, and format parameters')
+                return
+            lookup_options = argparse.Namespace(users=query.get('users', False), licensing=query.get('licensing', False), sort=query.get('sort', 'name'), user_export=None)
+            lookup_options.records = RecordWriter(record_format) if record_format != 'text' else None
+            lookup_clients = [client for client in clients if not query.get('stack') or query['stack'].lower() == client.name.lower()]
+            OUTPUT.lines = []
+            OUTPUT.warnings = []
+            try:
+                stack_results = []
+                for client in lookup_clients:
+                    index = indexes.get(client.name)
+                    stack_results.append((index is not None, index.match(query['customers']) if index else None))
+                output_customers(query['customers'], lookup_clients, stack_results, lookup_options)
+                # Warnings are returned separately, for the client to write to standard error.
+                response = json.dumps({'output': ''.join('%s\n' % line for line in OUTPUT.lines), 'warnings': OUTPUT.warnings}).encode()
+            # pylint: disable=broad-except
+            except Exception as ex:
+                # Such as an API error: respond (rather than dropping the connection) and keep serving.
+                OUTPUT.warnings = None
+                warn('Error answering a lookup: %s' % ex)
+                self.send_error(500, 'Lookup failed', str(ex))
+                return
+            finally:
+                OUTPUT.lines = None
+                OUTPUT.warnings = None
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    host, port = address.rsplit(':', 1)
+    server = ThreadingHTTPServer((host, int(port)), LookupHandler)
+    server.daemon_threads = True
+    refresh_indexes()
+    threading.Thread(target=refresh_loop, daemon=True).start()
+    output('Serving lookups on %s' % address)
+    server.serve_forever()
+
+def query_server(address, customers, options):
+    """ Send a lookup to a server (started with --serve) and output its response. """
+    # pylint: disable=import-outside-toplevel
+    import http.client
+    host, port = address.rsplit(':', 1)
+    query = {'customers': customers, 'users': options.users, 'licensing': options.licensing, 'sort': options.sort, 'stack': options.stack, 'format': options.format}
+    connection = http.client.HTTPConnection(host, int(port))
+    try:
+        connection.request('POST', '/lookup', json.dumps(query), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response_text = response.read().decode()
+    except OSError as ex:
+        output_status('Error connecting to the server (%s): %s' % (address, ex))
+        sys.exit(1)
+    if response.status != 200:
+        output_status('Server (%s) responded with an error\n%s' % (address, response_text))
+        sys.exit(1)
+    response = json.loads(response_text)
+    sys.stdout.write(response['output'])
+    for warning in response['warnings']:
+        warn(warning)
+
 ##########################################################################################
 ## Main.
 ##########################################################################################
@@ -242,16 +1214,22 @@ try:
     # pylint: disable=wildcard-import
     from config import *
 except ImportError:
-    output('Error reading configuration file: verify config.py exists in the same directory as this script.')
+    output_status('Error reading configuration file: verify config.py exists in the same directory as this script.')
     sys.exit(1)
 
+server_address = args.address or CONFIG.get('SERVER_ADDRESS', '127.0.0.1:8765')
+
+if args.client:
+    query_server(server_address, read_customers(args.customer_name), args)
+    sys.exit(0)
+
 configured = False
 for stack in CONFIG['STACKS']:
     if CONFIG['STACKS'][stack]['access_key'] is not None:
         configured = True
         break
 if not configured:
-    output('Error reading configuration file: verify credentials for at least one stack.')
+    output_status('Error reading configuration file: verify credentials for at least one stack.')
     sys.exit(1)
 
 if args.stack:
@@ -262,50 +1240,79 @@ if args.stack:
                 configured = True
                 break
     if not configured:
-        output('Error reading configuration file: verify credentials for the specified stack.')
+        output_status('Error reading configuration file: verify credentials for the specified stack.')
         sys.exit(1)
 
 if args.ca_bundle:
     CONFIG['CA_BUNDLE'] = args.ca_bundle
 
-if os.path.isfile(args.customer_name):
-    with open(args.customer_name, 'r', encoding='utf8') as f:
-        CONFIG['CUSTOMERS'] = json.load(f)
-else:
-    CONFIG['CUSTOMERS'] = [args.customer_name]
+stacks = []
+for stack in CONFIG['STACKS']:
+    if args.stack and args.stack.lower() != stack.lower():
+        continue
+    if CONFIG['STACKS'][stack]['access_key']:
+        stacks.append(stack)
 
-for customer in CONFIG['CUSTOMERS']:
-    found = 0
-    for stack in CONFIG['STACKS']:
-        if args.stack and args.stack.lower() != stack.lower():
-            continue
-        if CONFIG['STACKS'][stack]['access_key']:
-            output('Checking: %s' % stack)
-            output()
-            token = login(CONFIG['STACKS'][stack]['url'], CONFIG['STACKS'][stack]['access_key'], CONFIG['STACKS'][stack]['secret_key'], CONFIG['CA_BUNDLE'])
-            if not token:
-                output('Skipping %s because of authentication failure.' % stack)
-                output()
-                continue
-            customers_file_name = '/tmp/%s-customers.json' % re.sub(r'\W+', '', stack).lower()
-            if os.path.isfile(customers_file_name):
-                hours_ago = datetime.now() - timedelta(hours=8)
-                customers_file_date = datetime.fromtimestamp(os.path.getctime(customers_file_name))
-                if customers_file_date < hours_ago or args.cache is False:
-                    if DEBUG_MODE:
-                        output('Deleting cached stack file: %s' % customers_file_name)
-                    os.remove(customers_file_name)
-            if os.path.isfile(customers_file_name):
-                with open(customers_file_name, 'r', encoding='utf8') as f:
-                    if DEBUG_MODE:
-                        output('Reading cached stack file: %s' % customers_file_name)
-                    tenants = json.load(f)
-            else:
-                tenants = execute('GET', '%s/_support/customer' % CONFIG['STACKS'][stack]['url'], token, CONFIG['CA_BUNDLE'])
-                if tenants and args.cache:
-                    result_file = open(customers_file_name, 'w')
-                    result_file.write(json.dumps(tenants))
-                    result_file.close()
-            found += find_customer(stack, tenants, customer, CONFIG['STACKS'][stack]['url'], CONFIG['CA_BUNDLE'], token)
-    if found == 0:
-        output('%s not found on any configured stack' % customer)
+store = None
+response_cache = None
+if args.cache:
+    store = TenantStore(CONFIG.get('CACHE_FILE', '/tmp/pcs-where-is.sqlite3'))
+    response_cache = ResponseCache(CONFIG.get('CACHE_FILE', '/tmp/pcs-where-is.sqlite3'), CONFIG.get('RESPONSE_CACHE_SIZE', 10000))
+
+# One client per stack, reusing its session and token across all customers.
+clients = []
+for stack in stacks:
+    rate_limit = CONFIG['STACKS'][stack].get('rate_limit', CONFIG.get('RATE_LIMIT'))
+    clients.append(StackClient(stack, CONFIG['STACKS'][stack]['url'], CONFIG['STACKS'][stack]['access_key'], CONFIG['STACKS'][stack]['secret_key'], CONFIG['CA_BUNDLE'], DEBUG_MODE, args.detail_workers, CONFIG.get('RETRIES', 4), rate_limit=rate_limit, response_cache=response_cache, timeout=CONFIG.get('REQUEST_TIMEOUT', 60)))
+
+if args.serve:
+    serve(clients, store, server_address, args)
+    sys.exit(0)
+
+try:
+    routes = RouteMap(CONFIG.get('CACHE_FILE', '/tmp/pcs-where-is.sqlite3'))
+except sqlite3.Error as ex:
+    output_status('Not routing IDs, as the routes could not be read: %s' % ex)
+    routes = None
+
+if args.refresh:
+    for client in clients:
+        try:
+            refresh_stack(client, store, routes)
+        finally:
+            store.release_refresh(client.name)
+    sys.exit(0)
+
+start_time = time.time()
+
+# Each stack's tenant list is loaded and matched against all customers once.
+CONFIG['CUSTOMERS'] = read_customers(args.customer_name)
+matcher = TenantMatcher(CONFIG['CUSTOMERS'])
+
+args.user_export = UserExport(args.users_export) if args.users_export else None
+args.records = RecordWriter(args.format) if args.format != 'text' else None
+try:
+    stack_results = search_stacks(clients, matcher, store, routes, args)
+    output_customers(CONFIG['CUSTOMERS'], clients, stack_results, args)
+except APIError as ex:
+    warn(ex)
+    sys.exit(1)
+if args.user_export:
+    args.user_export.close()
+
+if DEBUG_MODE:
+    for client in clients:
+        output_status(client.stats_summary())
+    if response_cache:
+        output_status(response_cache.summary())
+    output_status('Elapsed time: %.2f seconds (%s)' % (time.time() - start_time, 'sequential' if args.workers == 1 else '%d workers' % args.workers))
+
+if PROFILER.enabled:
+    output_status()
+    output_status(PROFILER.report())
+    if response_cache:
+        output_status()
+        output_status(response_cache.summary())
+    if args.profile_json:
+        with open(args.profile_json, 'w', encoding='utf8') as f:
+            json.dump(PROFILER.summary(), f, indent=4)
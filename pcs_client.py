@@ -0,0 +1,505 @@
+""" Prisma Cloud Support API client, shared by the pcs-* scripts. """
+
+import codecs
+import json
+import math
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+##########################################################################################
+# Helpers.
+##########################################################################################
+
+def warn(warning):
+    # Warnings and errors are written to standard error, so that they are never mixed into (machine-readable) output.
+    sys.stderr.write('%s\n' % warning)
+
+def iter_json_array(chunks):
+    """ Yield the items of a JSON array from an iterable of (bytes) chunks, holding only one item (and chunk) in memory. """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        chunk = None
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # An item not followed by a separator may be a truncated number: read more to be sure.
+                if end < len(buffer) and buffer[end] in ' \t\r\n,]':
+                    position = end
+                    yield item
+                    continue
+            except ValueError:
+                pass
+        chunk = next(chunks, None)
+        if chunk is None:
+            if started and position < len(buffer):
+                item, end = decoder.raw_decode(buffer, position)
+                position = end
+                yield item
+                continue
+            raise ValueError('Incomplete JSON array')
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+
+def merge_pages(pages):
+    """ Merge the pages of a paged endpoint: concatenating their items, and adding up their stats. """
+    merged = None
+    for page in pages:
+        if page is None:
+            return None
+        if merged is None:
+            merged = dict(page, items=list(page.get('items') or []), stats=dict(page.get('stats') or {}))
+            continue
+        merged['items'].extend(page.get('items') or [])
+        for key, value in (page.get('stats') or {}).items():
+            merged['stats'][key] = merged['stats'].get(key, 0) + value
+    if merged is not None:
+        merged['nextPageToken'] = None
+    return merged
+
+##########################################################################################
+# Profiling.
+##########################################################################################
+
+class Profiler():
+    """ Durations (and bytes transferred) of API requests and other operations, by operation and stack. """
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, operation, stack, seconds, size=None):
+        """ Record an operation: an API request has a size (in bytes), other operations do not. """
+        if self.enabled:
+            with self.lock:
+                self.records.append((operation, stack, seconds, size))
+
+    @contextmanager
+    def timer(self, operation, stack=None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(operation, stack, time.perf_counter() - start_time)
+
+    @staticmethod
+    def percentile(values, percent):
+        """ Nearest-rank percentile of (sorted) values. """
+        return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+    def summary(self):
+        """ Statistics by operation, and by stack: API requests (and their duration and size), and the elapsed time of other operations. """
+        operations = {}
+        stacks = {}
+        with self.lock:
+            records = list(self.records)
+        for operation, stack, seconds, size in records:
+            operations.setdefault(operation, {'seconds': [], 'bytes': 0})
+            operations[operation]['seconds'].append(seconds)
+            operations[operation]['bytes'] += size or 0
+            if stack:
+                stacks.setdefault(stack, {'requests': 0, 'request_seconds': 0.0, 'bytes': 0, 'elapsed': 0.0})
+                if size is None:
+                    stacks[stack]['elapsed'] += seconds
+                else:
+                    stacks[stack]['requests'] += 1
+                    stacks[stack]['request_seconds'] += seconds
+                    stacks[stack]['bytes'] += size
+        result = {'operations': {}, 'stacks': dict(sorted(stacks.items()))}
+        for operation, values in sorted(operations.items()):
+            seconds = sorted(values['seconds'])
+            result['operations'][operation] = {
+                'count': len(seconds),
+                'p50': self.percentile(seconds, 50),
+                'p95': self.percentile(seconds, 95),
+                'max': seconds[-1],
+                'total': sum(seconds),
+                'bytes': values['bytes']
+            }
+        return result
+
+    def report(self):
+        summary = self.summary()
+        lines = ['%-*s %7s %9s %9s %9s %10s %12s' % (56, 'Operation', 'Count', 'p50', 'p95', 'Max', 'Total', 'Bytes')]
+        for operation, values in summary['operations'].items():
+            lines.append('%-*s %7d %9.3f %9.3f %9.3f %10.3f %12d' % (56, operation, values['count'], values['p50'], values['p95'], values['max'], values['total'], values['bytes']))
+        lines.append('')
+        lines.append('%-*s %7s %9s %12s %10s' % (56, 'Stack', 'Requests', 'Seconds', 'Bytes', 'Elapsed'))
+        for stack, values in summary['stacks'].items():
+            lines.append('%-*s %7d %9.3f %12d %10.3f' % (56, stack, values['requests'], values['request_seconds'], values['bytes'], values['elapsed']))
+        return '\n'.join(lines)
+
+# Shared by all clients: enable with PROFILER.enabled = True.
+PROFILER = Profiler()
+
+##########################################################################################
+# Rate limiting.
+##########################################################################################
+
+class TokenBucket():
+    """ Allow bursts of up to capacity requests, refilled at rate requests per second. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, waiting for one if necessary, and return the time waited. """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve a token, even if that takes the bucket into debt, so that waiters are served in order.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+##########################################################################################
+# Response cache.
+##########################################################################################
+
+class ResponseCache():
+    """ API responses, cached in a sqlite database until they expire, and evicted least recently used first. """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            expires REAL NOT NULL,
+            used REAL NOT NULL,
+            response BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+    '''
+
+    def __init__(self, file_name, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(self.SCHEMA)
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+    def get(self, key):
+        """ Return the cached response for key, or None if there is none, or it has expired. """
+        now = time.time()
+        with PROFILER.timer('response cache read'), self.lock, self.connection:
+            row = self.connection.execute('SELECT expires, response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            if row[0] <= now:
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            self.stats['hits'] += 1
+            self.connection.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+        return row[1]
+
+    def put(self, key, response, ttl):
+        """ Cache a response for ttl seconds, evicting the least recently used responses beyond max_entries. """
+        now = time.time()
+        with PROFILER.timer('response cache write'), self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, now + ttl, now, response))
+            evicted = self.connection.execute('''
+                DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)
+            ''', (self.max_entries,)).rowcount
+            self.stats['evicted'] += evicted
+
+    def summary(self):
+        return 'Response cache: %d hits, %d misses (%d expired), %d evicted' % (self.stats['hits'], self.stats['misses'], self.stats['expired'], self.stats['evicted'])
+
+##########################################################################################
+# Client.
+##########################################################################################
+
+# Returned by execute_stream() when a conditional request finds the response unchanged.
+NOT_MODIFIED = object()
+
+class APIError(Exception):
+    """ Raised for a (successful) API response that cannot be parsed. """
+
+class StackClient():
+    """ A stack, with a pooled session and an authentication token reused for the whole run. """
+
+    # Tokens are valid for ten minutes: renew them a little early.
+    TOKEN_LIFETIME = 9 * 60
+
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+    def __init__(self, name, url, access_key, secret_key, ca_bundle=None, debug=False, concurrency=4, retries=4, backoff=1.0, max_backoff=32.0, max_retry_after=600.0, rate_limit=None, response_cache=None, timeout=60):
+        self.name = name
+        self.url = url
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.ca_bundle = ca_bundle
+        self.debug = debug
+        self.token = None
+        self.token_time = 0
+        self.login_lock = threading.Lock()
+        self.concurrency = concurrency
+        self.http_session = None
+        self.session_lock = threading.Lock()
+        # Bounds the number of concurrent (submitted) requests to this stack: created on first use.
+        self.executor = None
+        # Prefetches the next pages of paged endpoints (separately, as pages are often consumed in the executor).
+        self.page_executor = None
+        self.retries = retries
+        # Seconds to wait to connect, and between bytes of a response, before raising requests.exceptions.Timeout (an OSError).
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # A (much larger) limit on the delay a stack asks for with Retry-After, as a safeguard against unreasonable values.
+        self.max_retry_after = max_retry_after
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        # Set when the stack throttles a request, to pause all requests to the stack.
+        self.paused_until = 0
+        # Responses are cached (in this ResponseCache) only for requests given a ttl.
+        self.response_cache = response_cache
+        self.stats = {'requests': 0, 'retries': 0, 'logins': 0, 'throttled': 0, 'waited': 0.0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """ The requests session, created (and requests imported) on first use, so that runs without API requests start faster. """
+        if self.http_session is None:
+            with self.session_lock:
+                if self.http_session is None:
+                    # pylint: disable=import-outside-toplevel
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    session.headers.update({'Content-Type': 'application/json'})
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.concurrency, 10))
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self.http_session = session
+        return self.http_session
+
+    def count(self, stat, value=1):
+        with self.stats_lock:
+            self.stats[stat] += value
+
+    def stats_summary(self):
+        return '%s: %d requests, %d retries, %d logins, %d throttled, %.1f seconds waiting' % (self.name, self.stats['requests'], self.stats['retries'], self.stats['logins'], self.stats['throttled'], self.stats['waited'])
+
+    def submit(self, function, *function_args):
+        """ Run function (typically calling execute) in this stack's bounded pool, returning a future. """
+        with self.session_lock:
+            if self.executor is None:
+                # pylint: disable=import-outside-toplevel
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=self.name)
+        return self.executor.submit(function, *function_args)
+
+    def prefetch(self, function, *function_args):
+        """ Like submit(), for functions run (and waited on) by functions already running in the executor. """
+        with self.session_lock:
+            if self.page_executor is None:
+                # pylint: disable=import-outside-toplevel
+                from concurrent.futures import ThreadPoolExecutor
+                self.page_executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='%s-pages' % self.name)
+        return self.page_executor.submit(function, *function_args)
+
+    def login(self, stale_token=None):
+        """ Return a valid token, logging in only if there is no token, it has expired, or it is the (rejected) stale_token. """
+        with self.login_lock:
+            if self.token and self.token != stale_token and time.time() - self.token_time < self.TOKEN_LIFETIME:
+                return self.token
+            action = 'POST'
+            url = '%s/login' % self.url
+            requ_data = json.dumps({'username': self.access_key, 'password': self.secret_key})
+            self.throttle()
+            self.count('logins')
+            start_time = time.perf_counter()
+            api_response = self.session.request(action, url, data=requ_data, verify=self.ca_bundle, timeout=self.timeout)
+            PROFILER.record('POST /login', self.name, time.perf_counter() - start_time, len(api_response.content))
+            self.token = None
+            if api_response.ok:
+                api_response = json.loads(api_response.content)
+                self.token = api_response.get('token')
+                self.token_time = time.time()
+            else:
+                warn('API (%s) responded with an error\n%s' % (url, api_response.text))
+            if self.debug:
+                # Debugging output is written (as warnings are) to standard error.
+                warn('%s\n%s\n%s\n%s\n' % (action, url, requ_data, api_response))
+            return self.token
+
+    def throttle(self):
+        """ Wait until the stack is no longer paused, and for the rate limiter. """
+        waited = 0
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+            waited += pause
+        if self.bucket:
+            waited += self.bucket.acquire()
+        if waited:
+            self.count('waited', waited)
+
+    def retry_delay(self, api_response, attempt):
+        """ Honor Retry-After (seconds or an HTTP date, up to max_retry_after), otherwise use exponential backoff (up to max_backoff) with full jitter. """
+        retry_after = api_response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                # pylint: disable=import-outside-toplevel
+                from email.utils import parsedate_to_datetime
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0), self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, action, endpoint, auth_token, requ_data=None, stream=False, headers=None):
+        self.throttle()
+        self.count('requests')
+        headers = dict(headers or {}, **{'x-redlock-auth': auth_token})
+        start_time = time.perf_counter()
+        api_response = self.session.request(action, '%s%s' % (self.url, endpoint), headers=headers, data=requ_data, verify=self.ca_bundle, stream=stream, timeout=self.timeout)
+        # A streamed response is profiled once it has been read, by iter_response().
+        if not stream:
+            PROFILER.record('%s %s' % (action, endpoint), self.name, time.perf_counter() - start_time, len(api_response.content))
+        return api_response
+
+    def send(self, action, endpoint, requ_data=None, stream=False, headers=None):
+        """ Send a request, retrying as necessary, and return the (final) response, or None. """
+        url = '%s%s' % (self.url, endpoint)
+        for attempt in range(self.retries + 1):
+            auth_token = self.login()
+            if not auth_token:
+                return None
+            api_response = self.request(action, endpoint, auth_token, requ_data, stream, headers)
+            if attempt == self.retries:
+                break
+            if api_response.status_code == 401:
+                # The token was rejected: log in again (once, across threads) and retry.
+                api_response.close()
+                self.count('retries')
+                self.login(stale_token=auth_token)
+                continue
+            if api_response.status_code in self.RETRY_STATUS_CODES:
+                api_response.close()
+                self.count('retries')
+                delay = self.retry_delay(api_response, attempt)
+                if api_response.status_code == 429:
+                    # Throttled: pause all requests to this stack, not just this one.
+                    self.count('throttled')
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                warn('Exceptional API response code %d received from %s. Waiting %.1f seconds and then retrying' % (api_response.status_code, url, delay))
+                if api_response.status_code != 429:
+                    time.sleep(delay)
+                    self.count('waited', delay)
+                continue
+            break
+        if api_response.status_code == 403:
+            warn('403 Unauthorized: check that credentials are valid and are authorized to access the API.')
+            return None
+        if self.debug:
+            warn('%s\n%s\n%s\n%s\n' % (action, url, requ_data, api_response.status_code))
+        return api_response
+
+    def execute(self, action, endpoint, requ_data=None, ttl=None):
+        """ Return the parsed response, or None, from the response cache (when given a ttl, in seconds) if possible. """
+        cache_key = None
+        if ttl and self.response_cache:
+            # Keyed on the stack, endpoint and request body.
+            cache_key = '%s %s%s %s' % (action, self.url, endpoint, requ_data)
+            content = self.response_cache.get(cache_key)
+            if content is not None:
+                with PROFILER.timer('parse %s' % endpoint):
+                    return json.loads(content)
+        result = None
+        api_response = self.send(action, endpoint, requ_data)
+        if api_response is not None and api_response.ok:
+            try:
+                with PROFILER.timer('parse %s' % endpoint):
+                    result = json.loads(api_response.content)
+            except ValueError as ex:
+                raise APIError('API (%s%s) responded with an error\n%s' % (self.url, endpoint, api_response.content)) from ex
+            if cache_key and result is not None:
+                self.response_cache.put(cache_key, api_response.content, ttl)
+        return result
+
+    def execute_pages(self, action, endpoint, query, page_token='pageToken', ttl=None):
+        """ Yield each page of a paged endpoint (following nextPageToken), requesting the next page while the current one is processed. """
+        page_future = self.prefetch(self.execute, action, endpoint, json.dumps(query), ttl)
+        while page_future:
+            page = page_future.result()
+            page_future = None
+            if page and page.get('nextPageToken'):
+                page_future = self.prefetch(self.execute, action, endpoint, json.dumps(dict(query, **{page_token: page['nextPageToken']})), ttl)
+            yield page
+
+    def execute_all_pages(self, action, endpoint, query, page_token='pageToken', ttl=None):
+        """ Return all pages of a paged endpoint merged into one (see merge_pages), or None if any page failed. """
+        return merge_pages(self.execute_pages(action, endpoint, query, page_token, ttl))
+
+    def execute_stream(self, action, endpoint, requ_data=None, validators=None):
+        """
+        Like execute(), but return a generator of the items of a JSON array response, parsed as it is read.
+        Given validators (the 'etag' and 'last_modified' of a previous response) the request is conditional, returning NOT_MODIFIED
+        if the response is unchanged, and validators are updated with those of the new response.
+        """
+        start_time = time.perf_counter()
+        headers = {}
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        api_response = self.send(action, endpoint, requ_data, stream=True, headers=headers)
+        if api_response is not None and api_response.status_code == 304:
+            api_response.close()
+            PROFILER.record('%s %s (not modified)' % (action, endpoint), self.name, time.perf_counter() - start_time, 0)
+            return NOT_MODIFIED
+        if api_response is None or not api_response.ok:
+            return None
+        if validators is not None:
+            validators['etag'] = api_response.headers.get('ETag')
+            validators['last_modified'] = api_response.headers.get('Last-Modified')
+        return self.iter_response(api_response, action, endpoint, start_time)
+
+    def iter_response(self, api_response, action, endpoint, start_time):
+        size = 0
+        def chunks():
+            nonlocal size
+            for chunk in api_response.iter_content(chunk_size=65536):
+                size += len(chunk)
+                yield chunk
+        try:
+            yield from iter_json_array(chunks())
+        except ValueError as ex:
+            raise APIError('API (%s%s) responded with an error' % (self.url, endpoint)) from ex
+        finally:
+            api_response.close()
+            # Includes the time taken to consume (match and cache) the items.
+            PROFILER.record('%s %s (streamed)' % (action, endpoint), self.name, time.perf_counter() - start_time, size)